@@ -0,0 +1,118 @@
+from __future__ import annotations
+from   typing   import Any
+
+import os
+import re
+import json
+import shlex
+import shutil
+import hashlib
+
+
+class Cache(object):
+
+    # what a pipe resolves from its items, case and exec that changes what it produces
+    item = ['args', 'env', 'cwd', 'stdin', 'stdout', 'stderr', 'wrap',
+            'sched', 'membind', 'cgroup', 'mem_max', 'cpu_max', 'timeout']
+    pipe = ['reps', 'warm', 'conf', 'stat', 'metric', 'tee',
+            'place', 'node', 'reserve', 'case_timeout', 'grace']
+
+    def __init__(self, d: str, mode: Any = 1):
+        self.out  = d
+        self.dir  = os.path.join(d, '.cache')
+        self.mode = mode
+
+    @staticmethod
+    def norm(v: Any) -> Any:
+        # json-able, objects by class and configuration, buffers and open state left out
+        if v is None or isinstance(v, (bool, int, float, str)):
+            return v
+        elif isinstance(v, (bytes, bytearray, memoryview)):
+            return None
+        elif isinstance(v, dict):
+            return {str(k): Cache.norm(w) for k, w in sorted(v.items(), key=lambda kv: str(kv[0]))}
+        elif isinstance(v, (set, frozenset)):
+            return sorted(map(Cache.norm, v), key=repr)
+        elif isinstance(v, (list, tuple)):
+            return list(map(Cache.norm, v))
+        elif hasattr(v, '__code__'):
+            # an edited metric or hook changes the key
+            return [v.__qualname__, hashlib.sha256(v.__code__.co_code + repr(v.__code__.co_consts).encode()).hexdigest()]
+        elif hasattr(v, '__qualname__'):
+            return f'{v.__module__}.{v.__qualname__}'
+        elif hasattr(v, '__dict__'):
+            return [f'{type(v).__module__}.{type(v).__qualname__}',
+                    Cache.norm({k: w for k, w in vars(v).items() if not k.startswith('rt_')})]
+        else:
+            return repr(v)
+
+    def stat(self, fn: str) -> Any:
+        # the file's identity, by content in hash mode
+        try:
+            st = os.stat(fn)
+        except OSError:
+            return None
+
+        if self.mode != 'hash':
+            return [fn, st.st_size, st.st_mtime_ns]
+
+        with open(fn, 'rb') as fi:
+            return [fn, hashlib.file_digest(fi, 'sha256').hexdigest()]
+
+    def key(self, p: Any) -> str:
+        dic = {k: Cache.norm(getattr(p, k)) for k in Cache.pipe}
+        dic['subs'] = []
+
+        for s in p.subs:
+            cwd = s.cwd if isinstance(s.cwd, str) else ''
+            env = os.environ | (s.env if isinstance(s.env, dict) else {})
+            arg = shlex.split(s.args) if isinstance(s.args, str) else s.args
+
+            # the executable as it resolves, and whatever the command line names that exists
+            exe = shutil.which(arg[0], path=env.get('PATH')) if arg else None
+            fns = [self.stat(os.path.join(cwd, a)) for a in arg[1:] if os.path.isfile(os.path.join(cwd, a))]
+
+            dic['subs'].append({k: Cache.norm(getattr(s, k)) for k in Cache.item} |
+                               {'exe': self.stat(exe) if exe else None, 'files': fns})
+
+        return hashlib.sha256(json.dumps(dic, sort_keys=True).encode()).hexdigest()
+
+    def get(self, n: str, key: str) -> bool:
+        # a hit needs the key and everything the run left behind
+        try:
+            with open(os.path.join(self.dir, f'{n}.json')) as fi:
+                ent = json.load(fi)
+        except (OSError, ValueError):
+            return False
+
+        return ent.get('key') == key and all(os.path.isfile(os.path.join(self.out, f)) for f in ent.get('files', []))
+
+    def put(self, n: str, key: str) -> None:
+        os.makedirs(self.dir, exist_ok=True)
+
+        # {case}-{idx}.log, {case}-{idx}.0.rusage, {case}-{idx}w0-..., {case}-{idx}-{stage}-{wrap}..., {case}-{idx}-{stage}.cg,
+        # not those of case {case}-{idx}, whose stage files have one more number: {case}-{idx}-{i}-{stage}-...
+        pat = re.compile(re.escape(n) + r'(\.|w\d+[.-]|-\d+(-\D|\.cgt?$))')
+        fns = sorted(f for f in os.listdir(self.out) if pat.match(f))
+
+        with open(os.path.join(self.dir, f'{n}.json.tmp'), 'w') as fo:
+            json.dump({'key': key, 'files': fns}, fo)
+
+        os.replace(os.path.join(self.dir, f'{n}.json.tmp'), os.path.join(self.dir, f'{n}.json'))
+
+    def rm(self, n: str) -> None:
+        try:
+            os.remove(os.path.join(self.dir, f'{n}.json'))
+        except FileNotFoundError:
+            pass
+
+    def drop(self, *c: str) -> None:
+        # the entries of the cases, all of them by default
+        try:
+            fns = os.listdir(self.dir)
+        except FileNotFoundError:
+            return
+
+        for f in fns:
+            if not c or any(re.match(re.escape(n) + r'-\d+\.json$', f) for n in c):
+                os.remove(os.path.join(self.dir, f))
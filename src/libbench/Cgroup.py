@@ -0,0 +1,291 @@
+from __future__ import annotations
+from   typing   import Any
+
+import os
+import time
+import signal
+
+
+class Cgroup(object):
+
+    # flat key value files, and the pressure ones
+    stat = ['cpu.stat', 'memory.stat']
+    psi  = ['cpu.pressure', 'memory.pressure', 'io.pressure']
+
+    # the parent of the leaves, the harness' own leaf in it and where the harness was, shared by the pipes
+    top  = ''
+    own  = ''
+    old  = ''
+
+    # the bases the controllers were handed down from
+    ctls = set()
+
+    def __init__(self, n: str, **kw: Any):
+        self.base = ''
+        self.mem  = None
+        self.cpu  = None
+        self.dly  = 0.0
+
+        self.__dict__.update(kw)
+
+        self.name = n
+        self.path = ''
+        self.pid  = 0
+
+    def __repr__(self) -> str:
+        return self.path
+
+    @staticmethod
+    def mount() -> str:
+        with open('/proc/self/mounts') as fi:
+            for cs in fi:
+                if (sp := cs.split())[2] == 'cgroup2':
+                    return sp[1]
+
+        return ''
+
+    @staticmethod
+    def cur() -> str:
+        # the v2 entry, 0::/path
+        with open('/proc/self/cgroup') as fi:
+            for cs in fi:
+                if cs.startswith('0::'):
+                    return cs[3:].strip()
+
+        return '/'
+
+    @staticmethod
+    def ctl(d: str) -> None:
+        # once per base, a cgroup with processes of its own can't hand the controllers down
+        if d in Cgroup.ctls:
+            return
+
+        Cgroup.ctls.add(d)
+
+        try:
+            with open(os.path.join(d, 'cgroup.controllers')) as fi:
+                have = fi.read().split()
+        except OSError:
+            have = []
+
+        # the parent of our own only has what ours hands down, that is already told
+        if (miss := [c for c in ['memory', 'cpu', 'io'] if c not in have]) and d != Cgroup.top:
+            print(f'WARNING: Cgroup: no {", ".join(miss)} controller in {d}, the runs have no accounting or limits of them')
+
+        for c in ['memory', 'cpu', 'io']:
+            if c not in have:
+                continue
+
+            try:
+                Cgroup.put(os.path.join(d, 'cgroup.subtree_control'), f'+{c}')
+            except OSError as e:
+                print(f'WARNING: Cgroup: +{c} in {d}: {e}, the runs have no {c}.* accounting or limits')
+
+    @staticmethod
+    def home(root: str) -> str:
+        # the leaves can't go next to ourselves, so the harness moves into a leaf of a dedicated parent
+        # and the leaves of the runs become its siblings
+        if Cgroup.top:
+            return Cgroup.top
+
+        cur = os.path.join(root, Cgroup.cur().lstrip(os.sep))
+        top = os.path.join(cur, f'libbench-{os.getpid()}')
+        own = os.path.join(top, 'harness')
+
+        try:
+            os.makedirs(own, exist_ok=True)
+            Cgroup.put(os.path.join(own, 'cgroup.procs'), str(os.getpid()))
+        except OSError as e:
+            print(f'WARNING: Cgroup: {e}, cannot leave {cur}, the runs are not accounted')
+            return ''
+
+        Cgroup.top = top
+        Cgroup.own = own
+        Cgroup.old = cur
+
+        Cgroup.ctl(cur)
+        Cgroup.ctl(top)
+
+        return top
+
+    @staticmethod
+    def leave() -> None:
+        # back to where the harness was, once the leaves are gone
+        if not Cgroup.top:
+            return
+
+        try:
+            Cgroup.put(os.path.join(Cgroup.old, 'cgroup.procs'), str(os.getpid()))
+            os.rmdir(Cgroup.own)
+            os.rmdir(Cgroup.top)
+        except OSError as e:
+            print(f'WARNING: Cgroup: {e}')
+
+        Cgroup.ctls -= {Cgroup.old, Cgroup.top}
+        Cgroup.top   = ''
+        Cgroup.own   = ''
+        Cgroup.old   = ''
+
+    def make(self) -> bool:
+        if not (root := Cgroup.mount()):
+            print(f'WARNING: Cgroup: no cgroup2 mount, {self.name} is not accounted')
+            return False
+
+        # under the given base, or a parent of our own
+        if isinstance(self.base, str) and self.base:
+            Cgroup.ctl(base := os.path.join(root, self.base.lstrip(os.sep)))
+        elif not (base := Cgroup.home(root)):
+            return False
+
+        path = os.path.join(base, self.name)
+
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            pass
+        except OSError as e:
+            print(f'WARNING: Cgroup: {e}, {self.name} is not accounted')
+            return False
+
+        self.path = path
+
+        if self.mem is not None:
+            self.lim('memory.max', str(self.mem))
+        if self.cpu is not None:
+            self.lim('cpu.max', self.cpu if isinstance(self.cpu, str) else f'{int(self.cpu * 100000)} 100000')
+
+        return True
+
+    @staticmethod
+    def put(fn: str, cs: str) -> None:
+        with open(fn, 'w') as fo:
+            fo.write(cs)
+
+    def lim(self, k: str, v: str) -> None:
+        try:
+            self.put(os.path.join(self.path, k), v)
+        except OSError as e:
+            print(f'WARNING: Cgroup: {k}: {e}, running without the limit')
+
+    def join(self) -> None:
+        # from the child, before the exec
+        if self.path:
+            try:
+                self.put(os.path.join(self.path, 'cgroup.procs'), '0')
+            except OSError as e:
+                print(f'WARNING: Cgroup: {e}')
+
+    def peak(self) -> int | None:
+        # memory.peak in KiB as ru_maxrss, none without the memory controller
+        try:
+            with open(os.path.join(self.path, 'memory.peak')) as fi:
+                return int(fi.read()) // 1024
+        except (OSError, ValueError):
+            return None
+
+    def read(self) -> dict[str, int]:
+        ret = {}
+
+        def get(k: str) -> list[str]:
+            try:
+                with open(os.path.join(self.path, k)) as fi:
+                    return fi.read().splitlines()
+            except OSError:
+                return []
+
+        for k in ['memory.peak', 'memory.current']:
+            if ls := get(k):
+                ret[k] = int(ls[0])
+
+        for f in Cgroup.stat:
+            for cs in get(f):
+                k, v = cs.split()
+                ret[f'{f.split(".")[0]}.{k}'] = int(v)
+
+        # summed over the devices: maj:min rbytes=... wbytes=...
+        for cs in get('io.stat'):
+            for kv in cs.split()[1:]:
+                k, v = kv.split('=')
+                ret[f'io.{k}'] = ret.get(f'io.{k}', 0) + int(v)
+
+        # some|full avg10=... avg60=... avg300=... total=...
+        for f in Cgroup.psi:
+            for cs in get(f):
+                sp = cs.split()
+
+                for kv in sp[1:]:
+                    k, v = kv.split('=')
+                    ret[f'{f}.{sp[0]}.{k}'] = float(v) if '.' in v else int(v)
+
+        return ret
+
+    def dump(self, fn: str) -> None:
+        with open(fn, 'w') as fo:
+            for k, v in self.read().items():
+                fo.write(f'{k} {v}\n')
+
+    def watch(self, fn: str) -> None:
+        # sampler process, killed by done
+        if not self.path or not self.dly:
+            return
+
+        if pid := os.fork():
+            self.pid = pid
+            return
+
+        # the parent's event loop owns the wakeup fd
+        signal.set_wakeup_fd(-1)
+
+        try:
+            with open(fn, 'w') as fo:
+                beg = time.time()
+
+                while True:
+                    now = self.read()
+                    fo.write(f'{time.time() - beg:.6f} '
+                             f'{now.get("memory.current", 0)} '
+                             f'{now.get("cpu.usage_usec", 0)} '
+                             f'{now.get("memory.pressure.some.total", 0)}\n')
+                    fo.flush()
+                    time.sleep(self.dly)
+        finally:
+            os._exit(0)
+
+    def kill(self) -> None:
+        # whatever is left, forks that escaped the pipe included
+        if not self.path:
+            return
+
+        try:
+            self.put(os.path.join(self.path, 'cgroup.kill'), '1')
+        except OSError:
+            return
+
+        for _ in range(100):
+            try:
+                with open(os.path.join(self.path, 'cgroup.events')) as fi:
+                    if 'populated 0' in fi.read():
+                        break
+            except OSError as e:
+                print(f'WARNING: Cgroup: {e}')
+                break
+
+            time.sleep(0.01)
+
+    def done(self) -> None:
+        if self.pid:
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+                os.waitpid(self.pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+
+            self.pid = 0
+
+        if self.path:
+            try:
+                os.rmdir(self.path)
+            except OSError as e:
+                print(f'WARNING: Cgroup: {e}')
+
+            self.path = ''
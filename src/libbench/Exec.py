@@ -5,6 +5,12 @@ import os
 
 from .Case import Case
 from .Item import Item
+from .Cache import Cache
+from .Cgroup import Cgroup
+from .Pool import Pool
+from .Post import Post
+from .Store import Store
+from .Topo import Topo
 
 
 class Exec(object):
@@ -46,6 +52,11 @@ class Exec(object):
         pipe += Item(case, a, **kw)
         return self
 
+    def drop(self, *c: str) -> Exec:
+        # forget the cached runs of the cases, all of them by default
+        Cache(self.dir).drop(*c)
+        return self
+
     def done(self, *c: str) -> None:
         try:
             os.mkdir(self.dir, 0o755)
@@ -53,7 +64,68 @@ class Exec(object):
             pass
 
         dic = set(c)
+        cpu = self.cpus
+
+        # a budget per call
+        for case in self.subs:
+            case.end = None
+        aff = os.sched_getaffinity(0)
+
+        # the harness and the samplers it forks on reserved cores, the stages on the others by policy
+        if self.place:
+            topo = Topo(self.cpus)
+
+            if res := topo.reserve(1 if self.reserve is None else int(self.reserve)):
+                os.sched_setaffinity(0, res)
+
+            cpu = topo.order(self.place, self.node)
+
+        # post-processing in the background when asked for and there is any, off the cores that are pinned
+        if self.post_jobs and any(s.wrap for case in self.subs if case.name in dic for p in case.subs for s in p.subs):
+            own = set(cpu or [])
+
+            for case in self.subs:
+                for p in case.subs:
+                    for s in p.subs:
+                        own |= set(s.sched or [])
+
+            self.post = Post(self.post_jobs, own)
+
+        # runs, rusage and the series parsed by the fmt_* of series, by wrapper name
+        if self.store:
+            self.db = Store(os.path.join(self.dir, self.store if isinstance(self.store, str) else 'results.db'))
+
+        # the cache entries of the clean runs that wait for their post-processing
+        self.held = []
+
+        try:
+            if self.jobs:
+                self.pool(dic, cpu)
+            else:
+                self.serial(dic, cpu)
+        finally:
+            # barrier
+            if self.post:
+                bad = self.post.join()
 
+                for n, ch, key in self.held:
+                    if n not in bad:
+                        ch.put(n, key)
+
+                self.post = None
+
+            self.held = []
+
+            if self.db:
+                self.db.feed(self.series or {})
+                self.db.close()
+                self.db = None
+
+            os.sched_setaffinity(0, aff)
+
+            Cgroup.leave()
+
+    def serial(self, dic: set[str], cpu: Any) -> None:
         for case in self.subs:
             if case.name not in dic:
                 continue
@@ -64,8 +136,35 @@ class Exec(object):
             for i, item in enumerate(case.subs):
                 print(f'  item: {i}: {item}')
 
+                old = [s.sched for s in item.subs]
+
+                if self.place:
+                    item.pin(cpu)
+
                 try:
                     item()
                 except KeyboardInterrupt:
                     item.done()
                     return
+                finally:
+                    for s, c in zip(item.subs, old):
+                        s.sched = c
+
+    def pool(self, dic: set[str], cpu: Any) -> None:
+        pool = Pool(int(self.jobs), cpu)
+
+        try:
+            for case in self.subs:
+                if case.name not in dic:
+                    continue
+
+                print(f'case: {case}')
+                case()
+
+                for i, item in enumerate(case.subs):
+                    pool(item)
+                    print(f'  item: {i}: {item}')
+
+            pool.join()
+        except KeyboardInterrupt:
+            pool.done()
@@ -6,6 +6,7 @@ import sys
 import shlex
 
 from .Case import Case
+from .Topo import Topo
 
 
 class Item(object):
@@ -27,19 +28,50 @@ class Item(object):
         self.rt_cwd  = []
         self.rt_env  = {}
         self.rt_args = []
+        self.rt_cg   = None
+        self.rt_post = -1
 
     def __repr__(self) -> str:
         return ' '.join(self.args)
 
-    def __call__(self, i: int, j: int) -> None:
+    def prep(self) -> None:
         self.rt_cwd  = self.cwd        if isinstance(self.cwd, str ) else ''
         self.rt_env  = self.env.copy() if isinstance(self.env, dict) else {}
         self.rt_args = self.args[::]
 
+    def spawn(self) -> int:
+        # what __call__ does in the child, without the fork: the stdio through file actions,
+        # the cwd and the affinity are inherited so the parent borrows them for the call, a session of its own as in Pipe
+        self.prep()
+
+        act = [(os.POSIX_SPAWN_DUP2, f, k) for k, f in enumerate([self.rt_in, self.rt_out, self.rt_err])]
+        cwd = os.getcwd()              if self.rt_cwd else None
+        aff = os.sched_getaffinity(0) if self.sched  else None
+
+        try:
+            if cwd:
+                os.chdir(self.rt_cwd)
+            if aff:
+                os.sched_setaffinity(0, self.sched)
+
+            return os.posix_spawnp(self.rt_args[0], self.rt_args, os.environ | self.rt_env, file_actions=act, setsid=True)
+        finally:
+            if cwd:
+                os.chdir(cwd)
+            if aff:
+                os.sched_setaffinity(0, aff)
+
+    def __call__(self, i: str, j: int) -> None:
+        self.prep()
+
         # insert special handlings
         if self.wrap and self.wrap(self, self.dir, i, j):
             sys.exit()
 
+        # only the wrapped process, not the wrapper
+        if self.rt_cg:
+            self.rt_cg.join()
+
         if self.rt_cwd:
             os.chdir(self.rt_cwd)
         if self.rt_env:
@@ -53,6 +85,8 @@ class Item(object):
 
         if self.sched:
             os.sched_setaffinity(os.getpid(), self.sched)
+        if self.membind is not None:
+            Topo.bind(Topo.mem(self.membind, self.sched))
 
         # no return
         os.execvp(self.rt_args[0], self.rt_args)
@@ -0,0 +1,196 @@
+from __future__ import annotations
+from   typing   import Any
+
+import os
+import re
+import array
+import operator
+import itertools
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class Load(object):
+
+    # raw columns of the rows, see Perf.ld_ch, Perf.ld_dt and WSS.watch
+    raw = {'perf_ldc': ['loads', 'l1_hit', 'l2_miss', 'l3_miss'],
+           'perf_tlb': ['loads', 'stlb_hit', 'walk', 'walk_pending'],
+           'wss'     : ['rss', 'pss', 'ref', 'ovh']}
+
+    # derived columns, in order, each one of the columns before it
+    metrics = {'perf_ldc': {'l1_miss' : lambda c: Load.sub(c['loads'  ], c['l1_hit' ]),
+                            'l1_ratio': lambda c: Load.div(c['l1_miss'], c['loads'  ]),
+                            'l2_ratio': lambda c: Load.div(c['l2_miss'], c['l1_miss']),
+                            'l3_ratio': lambda c: Load.div(c['l3_miss'], c['l2_miss'])},
+               'perf_tlb': {'l1_miss' : lambda c: Load.add(c['stlb_hit'], c['walk']),
+                            'l1_ratio': lambda c: Load.div(c['l1_miss' ], c['loads'  ]),
+                            'l2_ratio': lambda c: Load.div(c['walk'    ], c['l1_miss'])},
+               'wss'     : {'rss_mb'  : lambda c: Load.mul(c['rss'], 1 / 1024),
+                            'pss_mb'  : lambda c: Load.mul(c['pss'], 1 / 1024),
+                            'ref_mb'  : lambda c: Load.mul(c['ref'], 1 / 1024)}}
+
+    # the columns of fmt_perf_ldc, fmt_perf_tlb and fmt_wss
+    outs = {'perf_ldc': ['idx', 'l1_ratio', 'l2_ratio', 'l3_ratio'],
+            'perf_tlb': ['idx', 'loads', 'l1_ratio', 'l2_ratio', 'walk_pending'],
+            'wss'     : ['idx', 'rss_mb', 'pss_mb', 'ref_mb']}
+
+    # the files of a directory, see Perf.path and WSS.prep
+    pats = {'perf_ldc': r'-perf\.data\.post$',
+            'perf_tlb': r'-perf\.data\.post$',
+            'wss'     : r'-wss-[\d.]+\.log$'}
+
+    def __init__(self, fmt: str, *cols: str, **kw: Any):
+        self.jobs = 0
+        self.pat  = Load.pats.get(fmt, r'\.post$')
+
+        self.__dict__.update(kw)
+
+        if fmt not in Load.raw:
+            raise ValueError(f'Load: unknown format {fmt}, one of {", ".join(Load.raw)}')
+
+        self.fmt  = fmt
+        self.subs = list(cols) or Load.outs[fmt]
+
+        if bad := set(self.subs) - {'idx', *Load.raw[fmt], *Load.metrics.get(fmt, {})}:
+            raise ValueError(f'Load: unknown columns {", ".join(sorted(bad))} of {fmt}')
+
+    @staticmethod
+    def define(fmt: str, name: str, fn: Any) -> None:
+        # a derived column, e.g. Load.define('perf_ldc', 'l3_per_load', lambda c: Load.div(c['l3_miss'], c['loads']))
+        Load.metrics.setdefault(fmt, {})[name] = fn
+
+    @staticmethod
+    def add(a: Any, b: Any) -> Any:
+        return a + b if np else Load.each(operator.add, a, b)
+
+    @staticmethod
+    def sub(a: Any, b: Any) -> Any:
+        return a - b if np else Load.each(operator.sub, a, b)
+
+    @staticmethod
+    def mul(a: Any, b: Any) -> Any:
+        return a * b if np else Load.each(operator.mul, a, b)
+
+    @staticmethod
+    def div(a: Any, b: Any) -> Any:
+        # 0 where b is, as float_div
+        if np:
+            return np.divide(a, b, out=np.zeros(np.broadcast(a, b).shape), where=np.asarray(b) != 0)
+
+        try:
+            return Load.each(operator.truediv, a, b)
+        except ZeroDivisionError:
+            return Load.each(lambda x, y: x / y if y else 0.0, a, b)
+
+    @staticmethod
+    def each(fn: Any, a: Any, b: Any) -> array.array:
+        if not isinstance(b, array.array):
+            b = itertools.repeat(float(b))
+
+        return array.array('d', map(fn, a, b))
+
+    @staticmethod
+    def parse(buf: bytes, n: int) -> Any:
+        # the rows in one go, row by row only when some of them are not n numbers
+        try:
+            if np:
+                return np.array(buf.split(), dtype=np.float64).reshape(-1, n).T
+
+            if len(v := array.array('d', map(float, buf.split()))) % n:
+                raise ValueError
+        except ValueError:
+            v = array.array('d')
+
+            for cs in buf.splitlines():
+                try:
+                    if len(sp := [float(s) for s in cs.split()]) == n:
+                        v.extend(sp)
+                except ValueError:
+                    continue
+
+            if np:
+                return np.frombuffer(v, dtype=np.float64).reshape(-1, n).T
+
+        return [v[k::n] for k in range(n)]
+
+    def file(self, fn: str) -> Any:
+        # columns x rows, a 2-d array with numpy and a list of array('d') without
+        with open(fn, 'rb') as fi:
+            buf = fi.read()
+
+        # a torn last row of a killed watcher is dropped
+        buf = buf[:buf.rfind(b'\n') + 1]
+        n   = len(Load.raw[self.fmt])
+
+        if buf and len(buf.split(b'\n', 1)[0].split()) != n:
+            raise ValueError(f'Load: {fn}: not {self.fmt}, expected {n} columns')
+
+        raw = Load.parse(buf, n)
+        num = len(raw[0])
+        col = dict(zip(Load.raw[self.fmt], raw))
+
+        col['idx'] = np.arange(num, dtype=np.float64) if np else array.array('d', range(num))
+
+        for k, f in Load.metrics.get(self.fmt, {}).items():
+            col[k] = f(col)
+
+        ret = [col[k] for k in self.subs]
+
+        return np.stack(ret) if np else ret
+
+    @staticmethod
+    def rows(v: Any) -> tuple[int, bytes]:
+        # (cols, float64 rows) of what file returns, as Store keeps series
+        if np:
+            return len(v), np.ascontiguousarray(v.T).tobytes()
+
+        return len(v), array.array('d', itertools.chain.from_iterable(zip(*v))).tobytes()
+
+    def files(self, *fns: str) -> list[str]:
+        # directories to the files of the format in them
+        ret = []
+
+        for fn in fns:
+            if os.path.isdir(fn):
+                ret.extend(os.path.join(fn, f) for f in sorted(os.listdir(fn)) if re.search(self.pat, f))
+            else:
+                ret.append(fn)
+
+        return ret
+
+    def many(self, fns: list[str]) -> dict[str, Any]:
+        ret = {}
+
+        for fn in fns:
+            try:
+                ret[fn] = self.file(fn)
+            except OSError as e:
+                print(f'WARNING: Load: {e}')
+            except ValueError as e:
+                print(f'WARNING: {e}')
+
+        return ret
+
+    def __call__(self, *fns: str) -> dict[str, Any]:
+        # file -> columns, the files are parsed in parallel, a few chunks per worker,
+        # and the ones that fail are left out
+        fns = self.files(*fns)
+        num = min(int(self.jobs) if self.jobs else os.cpu_count() or 1, len(fns))
+
+        if num <= 1:
+            return self.many(fns)
+
+        ret = {}
+        cnk = -(-len(fns) // (num * 4))
+
+        with ProcessPoolExecutor(num, mp_context=multiprocessing.get_context('fork')) as pool:
+            for r in pool.map(self.many, [fns[k:k + cnk] for k in range(0, len(fns), cnk)]):
+                ret.update(r)
+
+        return ret
@@ -2,15 +2,33 @@ from __future__ import annotations
 from   typing   import Any
 
 import os
+import sys
+import time
+import pickle
 import signal
+import asyncio
+import traceback
 
 from .Item import Item
 from .Case import Case
+from .Stat import COLS, rel, summ
+from .Cache import Cache
+from .Cgroup import Cgroup
+from .Topo import Topo
 
 
 SOUT = -1
 NULL = -2
 
+# run budget of the adaptive mode
+REPS = 30
+
+# per stage, from wait4
+RUSE = ['wall', 'utime', 'stime', 'maxrss', 'minflt', 'majflt', 'nvcsw', 'nivcsw', 'status', 'timeout', 'launch']
+
+# between sigterm and sigkill
+GRACE = 5.0
+
 
 class Pipe(object):
     null = os.open(os.path.join(os.sep, 'dev', 'null'), os.O_RDWR)
@@ -19,7 +37,16 @@ class Pipe(object):
         self.case =  c
         self.subs = [i]
         self.pids = {}
+        self.sids = set()
         self.idx  =  0
+        self.tag  = '0'
+        self.runs = {}
+        self.res  = []
+        self.lat  = {}
+        self.cap  = None
+        self.ok   = True
+        self.jfd  = -1
+        self.jbuf = b''
 
     def __iadd__(self, i: Item) -> Pipe:
         self.subs.append(i)
@@ -29,6 +56,135 @@ class Pipe(object):
         return ' | '.join(map(repr, self.subs))
 
     def __call__(self) -> None:
+        asyncio.run(self.run())
+
+    async def run(self) -> None:
+        # skipped when nothing it depends on changed since its last clean run
+        if not self.cache or not self.dir:
+            return await self.rep()
+
+        ch  = Cache(self.dir, self.cache)
+        key = ch.key(self)
+        n   = f'{self.case}-{self.idx}'
+
+        if not self.force and ch.get(n, key):
+            print(f'  cached: {n}: {self}')
+            return
+
+        # an interrupted run must not leave a hit behind
+        ch.rm(n)
+
+        self.ok = True
+        await self.rep()
+
+        # the .post files aren't there before the barrier, nor known to be clean
+        if self.ok and self.post:
+            self.held.append((n, ch, key))
+        elif self.ok:
+            ch.put(n, key)
+
+    async def rep(self) -> None:
+        # the case budget starts with its first pipe
+        if self.case_timeout and self.case.end is None:
+            self.case.end = time.monotonic() + float(self.case_timeout)
+
+        num = int(self.reps) if self.reps else REPS if self.conf else 1
+
+        if num == 1 and not self.warm:
+            self.tag = str(self.idx)
+            await self.once()
+            return
+
+        for k in range(int(self.warm or 0)):
+            self.tag = f'{self.idx}w{k}'
+
+            if await self.once():
+                self.tag = str(self.idx)
+                return
+
+        met       = self.metric or {}
+        self.runs = {'wall': [], 'utime': [], 'stime': [], 'maxrss': [], 'launch': []} | {m: [] for m in met}
+
+        for k in range(num):
+            self.tag = f'{self.idx}.{k}'
+
+            dif = time.perf_counter()
+            if await self.once():
+                break
+            dif = time.perf_counter() - dif
+
+            self.runs['wall'  ].append(dif)
+            self.runs['utime' ].append(sum(r['utime'] for r in self.res))
+            self.runs['stime' ].append(sum(r['stime'] for r in self.res))
+            self.runs['maxrss'].append(max(r['maxrss'] for r in self.res))
+            self.runs['launch'].append(sum(r['launch'] for r in self.res))
+            for m, f in met.items():
+                self.runs[m].append(float(f(self.cap.fn if self.cap else self.log())))
+
+            # stop as soon as the confidence interval is tight enough
+            if self.conf and k >= 2 and rel(self.runs[self.stat or 'wall']) <= self.conf:
+                break
+
+        self.tag = str(self.idx)
+
+        if self.dir:
+            self.summ()
+
+    def log(self) -> str:
+        return os.path.join(self.dir, f'{self.case}-{self.tag}.log')
+
+    def summ(self) -> None:
+        fn = os.path.join(self.dir, f'{self.case}-{self.idx}')
+
+        with open(f'{fn}.runs', 'w') as fo:
+            fo.write('# ' + ' '.join(self.runs) + '\n')
+            for r in zip(*self.runs.values()):
+                fo.write(' '.join(map(str, r)) + '\n')
+
+        with open(f'{fn}.sum', 'w') as fo:
+            fo.write('# name ' + ' '.join(COLS) + '\n')
+            for m, r in self.runs.items():
+                fo.write(f'{m} ' + ' '.join(map(str, summ(r))) + '\n')
+
+    def pin(self, cpu: list[int]) -> None:
+        # the stages that aren't pinned already, a core each when placed, the whole set otherwise
+        for k, s in enumerate(self.subs):
+            if s.sched is None:
+                s.sched = [cpu[k % len(cpu)]] if self.place else cpu
+
+    def lim(self) -> float | None:
+        # the tightest of the items' timeouts and what is left of the case budget
+        ts = [float(s.timeout) for s in self.subs if s.timeout]
+
+        if self.case.end is not None:
+            ts.append(self.case.end - time.monotonic())
+
+        return min(ts) if ts else None
+
+    async def once(self) -> bool:
+        # true when the run timed out or could not start
+        if (lim := self.lim()) is not None and lim <= 0:
+            print(f'WARNING: Pipe: {self.case} is out of time, skipping {self}')
+            self.ok = False
+            return True
+
+        now  = time.time()
+        beg  = self.spawn()
+        late = await self.wait(beg, lim)
+
+        self.save()
+
+        if self.db:
+            self.db.put(self, now, time.time())
+
+        self.ok = self.ok and not late and all(r.get('status') == 0 for r in self.res)
+
+        if late:
+            print(f'WARNING: Pipe: {self.case}-{self.tag} timed out after {lim:g}s')
+
+        return late
+
+    def spawn(self) -> dict[int, float]:
         def fd(m: Item, o: int, std: Any):
             if std is None:
                 return o
@@ -47,9 +203,18 @@ class Pipe(object):
         p = self.subs[ 0]
         p.rt_in  = fd(p, 0, p.stdin)
         c = self.subs[-1]
-        c.rt_out = fd(c, 1, os.path.join(self.dir, f'{self.case}-{self.idx}.log') if self.dir else None)
         c.rt_err = fd(c, 2, c.stderr)
 
+        # through the harness instead of straight into the log
+        if self.tee and self.dir:
+            self.cap = self.tee.open(self.log())
+            c.rt_out = self.cap.w
+
+            if self.cap.err:
+                c.rt_err = self.cap.w
+        else:
+            c.rt_out = fd(c, 1, self.log() if self.dir else None)
+
         for p, c in zip(self.subs[:-1], self.subs[1:]):
             # ignore user settings
             r, w     = os.pipe()
@@ -60,28 +225,283 @@ class Pipe(object):
             p.stdiop.append(r)
 
         for i, s in enumerate(self.subs):
-            if (p := os.fork()) == 0:
-                s(self.idx, i)
-            else:
-                self.pids[p] = True
+            if s.cgroup:
+                s.rt_cg = Cgroup(f'libbench-{os.getpid()}-{self.case}-{self.tag}-{i}',
+                                 base=s.cgroup,
+                                 mem =s.mem_max,
+                                 cpu =s.cpu_max,
+                                 dly =s.cg_dly or 0.0)
+                if not s.rt_cg.make():
+                    s.rt_cg = None
+
+        # the wrappers hand their post-processing back through it
+        if self.post:
+            self.jfd, jw = os.pipe()
+
+            os.set_blocking(self.jfd, False)
+
+            for s in self.subs:
+                s.rt_post = jw
+
+        beg = {}
+
+        self.sids = set()
+
+        for i, s in enumerate(self.subs):
+            beg[i] = time.perf_counter()
+            p      = 0
+
+            # no fork for the stages that need nothing done in the child, the fork path reports the failures
+            if not (s.wrap or s.rt_cg or s.membind is not None or s.fork):
+                try:
+                    p = s.spawn()
+                except OSError:
+                    pass
+
+            if not p and (p := os.fork()) == 0:
+                # a session of its own, so that a timeout reaches whatever the stage forks
+                os.setsid()
+
+                # never unwind into the loop of the parent, nor share its signal handling
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+
+                try:
+                    s(self.tag, i)
+                except SystemExit as e:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(e.code if isinstance(e.code, int) else 0)
+                except KeyboardInterrupt:
+                    pass
+                except BaseException:
+                    traceback.print_exc()
+                    sys.stderr.flush()
+                os._exit(1)
+
+            self.pids[p] = i
+            self.sids.add(p)
+            self.lat [i] = time.perf_counter() - beg[i]
 
         for s in self.subs:
             for f in s.stdiop:
                 os.close(f)
+            s.stdiop = []
 
-        while True:
-            self.pids.pop(os.waitpid(0, 0)[0], True)
-            if not self.pids:
-                break
+        if self.cap:
+            os.close(self.cap.w)
+            self.cap.w = -1
+
+        if self.jfd >= 0:
+            os.close(jw)
+
+            for s in self.subs:
+                s.rt_post = -1
+
+        # the samplers must not hold the pipes open
+        for i, s in enumerate(self.subs):
+            if s.rt_cg and self.dir:
+                s.rt_cg.watch(os.path.join(self.dir, f'{self.case}-{self.tag}-{i}.cgt'))
+
+        self.res = [{} for _ in self.subs]
+
+        return beg
+
+    def recv(self) -> bool:
+        # true on eof
+        try:
+            while buf := os.read(self.jfd, 1 << 16):
+                self.jbuf += buf
+        except BlockingIOError:
+            return False
+
+        return True
+
+    def tail(self, n: int = 0) -> list[str]:
+        # of the last run
+        return self.cap.tail(n) if self.cap else []
+
+    def save(self) -> None:
+        if self.cap:
+            self.cap.close()
+
+        # (item index, [(wrapper, file)]) from each wrapped stage
+        if self.jfd >= 0:
+            self.recv()
+
+            os.close(self.jfd)
+            self.jfd = -1
+
+            buf, self.jbuf = self.jbuf, b''
+
+            while buf:
+                n      = int.from_bytes(buf[:4], 'little')
+                i, job = pickle.loads(buf[4:4 + n])
+                buf    = buf[4 + n:]
+
+                self.post(f'{self.case}-{self.tag}-{i}: {self.subs[i]}', job, f'{self.case}-{self.idx}')
+
+        if self.dir and (self.place or any(s.sched for s in self.subs)):
+            aff = os.sched_getaffinity(0)
+
+            with open(os.path.join(self.dir, f'{self.case}-{self.tag}.place'), 'w') as fo:
+                fo.write('# idx cpus nodes membind\n')
+                fo.write(f'harness {Topo.fmt(aff)} {Topo.fmt(Topo.where(aff))} -\n')
+                for i, s in enumerate(self.subs):
+                    fo.write(f'{i} {Topo.fmt(s.sched)} {Topo.fmt(Topo.where(s.sched or aff))} '
+                             f'{Topo.fmt(Topo.mem(s.membind, s.sched))}\n')
+
+        # exec keeps the high-water mark of the mm it replaces, a fork or vfork of the harness,
+        # so wait4's maxrss is at least the harness's own and the cgroup's peak is taken instead when there is one
+        for i, s in enumerate(self.subs):
+            if s.rt_cg and self.res[i] and (pk := s.rt_cg.peak()) is not None:
+                self.res[i]['maxrss'] = pk
+
+        if self.dir:
+            with open(os.path.join(self.dir, f'{self.case}-{self.tag}.rusage'), 'w') as fo:
+                fo.write('# maxrss in KiB, from memory.peak with a cgroup, else from wait4 and no lower than the harness\n')
+                fo.write('# idx ' + ' '.join(RUSE) + '\n')
+                for i, r in enumerate(self.res):
+                    fo.write(f'{i} ' + ' '.join(str(r.get(k, 0)) for k in RUSE) + '\n')
+
+        for i, s in enumerate(self.subs):
+            if s.rt_cg:
+                if self.dir:
+                    s.rt_cg.dump(os.path.join(self.dir, f'{self.case}-{self.tag}-{i}.cg'))
+
+                s.rt_cg.done()
+                s.rt_cg = None
+
+    async def wait(self, beg: dict[int, float], lim: float | None) -> bool:
+        # only our own stages, each reaped as soon as its pidfd is readable
+        loop = asyncio.get_running_loop()
+        idx  = dict(self.pids)
+        fut  = {}
+        fds  = {}
+
+        def exit(f: int, p: int) -> None:
+            loop.remove_reader(f)
+            os.close(f)
+            del fds[f]
+
+            fut[p].set_result(os.wait4(p, 0))
+
+        # drained as it goes, the stages block on a full pipe
+        if self.jfd >= 0:
+            loop.add_reader(self.jfd, lambda: self.recv() and loop.remove_reader(self.jfd))
+        if self.cap:
+            loop.add_reader(self.cap.r, lambda: self.cap.pump() and loop.remove_reader(self.cap.r))
+
+        try:
+            for p in idx:
+                try:
+                    f = os.pidfd_open(p)
+                except (AttributeError, OSError):
+                    # no pidfd, a blocking wait4 in the default executor then
+                    fut[p] = loop.run_in_executor(None, os.wait4, p, 0)
+                else:
+                    fds[f] = p
+                    fut[p] = loop.create_future()
+                    loop.add_reader(f, exit, f, p)
+
+                fut[p].add_done_callback(lambda r, p=p: r.cancelled() or self.rec(p, beg, *r.result()[1:]))
+
+            _, pend = await asyncio.wait(fut.values(), timeout=lim)
+            slow    = [p for p, f in fut.items() if f in pend]
+
+            # escalate
+            if pend:
+                self.kill(signal.SIGTERM)
+                _, pend = await asyncio.wait(pend, timeout=float(self.grace or GRACE))
+            if pend:
+                self.kill(signal.SIGKILL)
+                await asyncio.wait(pend)
+
+            # the last done callbacks
+            await asyncio.sleep(0)
+
+            for p in slow:
+                self.res[idx[p]]['timeout'] = 1
+
+            return bool(slow)
+        finally:
+            for f in fds:
+                loop.remove_reader(f)
+                os.close(f)
+
+            if self.jfd >= 0:
+                loop.remove_reader(self.jfd)
+            if self.cap:
+                loop.remove_reader(self.cap.r)
+
+    def rec(self, p: int, beg: dict[int, float], st: int, ru: Any) -> None:
+        i = self.pids.pop(p)
+
+        self.res[i] = {'wall'  : time.perf_counter() - beg[i],
+                       'utime' : ru.ru_utime,
+                       'stime' : ru.ru_stime,
+                       'maxrss': ru.ru_maxrss,
+                       'minflt': ru.ru_minflt,
+                       'majflt': ru.ru_majflt,
+                       'nvcsw' : ru.ru_nvcsw,
+                       'nivcsw': ru.ru_nivcsw,
+                       'status': os.waitstatus_to_exitcode(st),
+                       'timeout': 0,
+                       'launch': self.lat[i]}
+
+    @staticmethod
+    def grps(sids: set[int]) -> set[int]:
+        # the process groups in the sessions, those of the tree wrappers and of the forks of exited stages too
+        ret = set()
+
+        for d in os.listdir('/proc'):
+            if not d.isdigit():
+                continue
 
-    def done(self) -> None:
-        for p in self.pids:
             try:
-                os.kill(p, signal.SIGKILL)
-            except ProcessLookupError:
+                with open(f'/proc/{d}/stat', 'rb') as fi:
+                    _, pg, sid = fi.read().rsplit(b')', 1)[1].split()[1:4]
+            except (OSError, ValueError):
+                continue
+
+            if int(sid) in sids:
+                ret.add(int(pg))
+
+        return ret
+
+    def kill(self, sig: int) -> None:
+        # every stage leads a session, a stopped group (WSS) only acts on it once continued
+        for g in Pipe.grps(self.sids) | set(self.pids):
+            try:
+                os.killpg(g, sig)
+                os.killpg(g, signal.SIGCONT)
+            except (ProcessLookupError, PermissionError):
                 pass
 
+        # the forks of the wrappers too
+        if sig == signal.SIGKILL:
+            for s in self.subs:
+                if s.rt_cg:
+                    s.rt_cg.kill()
+
+    def done(self) -> None:
+        self.kill(signal.SIGKILL)
+
         self.pids = {}
+        self.sids = set()
+
+        if self.jfd >= 0:
+            os.close(self.jfd)
+            self.jfd = -1
+
+        if self.cap:
+            self.cap.close()
+
+        for s in self.subs:
+            if s.rt_cg:
+                s.rt_cg.kill()
+                s.rt_cg.done()
+                s.rt_cg = None
 
     def __getattr__(self, k: str) -> Any:
         return getattr(self.case, k)
@@ -0,0 +1,65 @@
+from __future__ import annotations
+from   typing   import Any
+
+import os
+import asyncio
+import traceback
+
+from .Pipe import Pipe
+
+
+class Pool(object):
+
+    def __init__(self, n: int, cpu: Any = None):
+        # in the order of the placement, if any
+        cpu = list(cpu) if cpu else sorted(os.sched_getaffinity(0))
+
+        if n > len(cpu):
+            print(f'WARNING: Pool: {n} jobs on {len(cpu)} cpus, limiting to {len(cpu)}')
+            n = len(cpu)
+
+        # disjoint cpu slots, one per running pipe
+        num = len(cpu) // n
+
+        self.free = [cpu[k * num:(k + 1) * num] for k in range(n)]
+        self.subs = []
+
+    def __call__(self, p: Pipe) -> None:
+        self.subs.append(p)
+
+    async def one(self, p: Pipe, free: asyncio.Queue) -> None:
+        cpu = await free.get()
+        old = [s.sched for s in p.subs]
+
+        p.pin(cpu)
+
+        try:
+            await p.run()
+        except asyncio.CancelledError:
+            p.done()
+            raise
+        finally:
+            for s, c in zip(p.subs, old):
+                s.sched = c
+
+            free.put_nowait(cpu)
+
+    async def run(self) -> None:
+        # one loop supervises all the running pipes
+        free = asyncio.Queue()
+
+        for c in self.free:
+            free.put_nowait(c)
+
+        # a failing pipe doesn't take the others down
+        for p, r in zip(self.subs, await asyncio.gather(*[self.one(p, free) for p in self.subs], return_exceptions=True)):
+            if isinstance(r, Exception):
+                print(f'WARNING: Pool: {p}: {r!r}')
+                traceback.print_exception(r)
+
+    def join(self) -> None:
+        asyncio.run(self.run())
+
+    def done(self) -> None:
+        for p in self.subs:
+            p.done()
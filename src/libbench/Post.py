@@ -0,0 +1,75 @@
+from __future__ import annotations
+from   typing   import Any
+
+import os
+import signal
+import traceback
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+
+class Post(object):
+
+    def __init__(self, n: Any = 0, cpu: Any = None):
+        # off the cores of the benchmarks when there are any left, and behind them anyway
+        own = os.sched_getaffinity(0)
+        cpu = own - set(cpu or []) or own
+
+        # a few workers unless told, they only compete with the benchmarks
+        self.num  = int(n) if n is not True and n else min(4, len(cpu))
+        self.cpu  = cpu
+        self.subs = []
+        self.pool = None
+
+    @staticmethod
+    def init(cpu: set[int]) -> None:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        os.sched_setaffinity(0, cpu)
+        os.nice(19)
+
+    def __call__(self, tag: str, jobs: list[tuple[Any, str]], grp: str = '') -> None:
+        # the workers are forked on the first job, a run without any never has them
+        if self.pool is None and jobs:
+            self.pool = ProcessPoolExecutor(self.num,
+                                            mp_context =multiprocessing.get_context('fork'),
+                                            initializer=Post.init,
+                                            initargs   =(self.cpu,))
+
+        for w, fn in jobs:
+            self.subs.append((grp, tag, fn, self.pool.submit(w.post, fn)))
+
+    def join(self) -> set[str]:
+        # the groups with a failed job
+        if self.subs:
+            print(f'post: waiting for {sum(not f.done() for *_, f in self.subs)} of {len(self.subs)} jobs')
+
+        bad = set()
+        num = 0
+
+        try:
+            for grp, tag, fn, f in self.subs:
+                try:
+                    f.result()
+                except Exception as e:
+                    bad.add(grp)
+                    num += 1
+
+                    print(f'WARNING: Post: {tag}: {fn}: {e!r}')
+                    traceback.print_exception(e)
+        except KeyboardInterrupt:
+            if self.pool:
+                self.pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        finally:
+            self.subs = []
+
+        if num:
+            print(f'WARNING: Post: {num} jobs failed')
+
+        if self.pool:
+            self.pool.shutdown()
+            self.pool = None
+
+        return bad
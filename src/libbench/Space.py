@@ -0,0 +1,265 @@
+from __future__ import annotations
+
+import os
+import mmap
+import bisect
+import heapq
+import struct
+
+
+class Space(object):
+
+    # columns of the timeline, bytes except for the time
+    cols = ['t', 'total', 'anon', 'file', 'r', 'w', 'x', 'none', 'max']
+
+    # one row of the timeline
+    row  = struct.Struct('<d8q')
+
+    # starts per bucket of the sorted starts, split at twice that
+    bkt  = 512
+
+    def __init__(self, dly: float = 0.0, out: str | None = None):
+        self.dly  = dly
+
+        # non-overlapping vmas: start -> (end, (prot, kind)), the starts sorted in buckets with their maxima
+        self.vmas = {}
+        self.keys = []
+        self.maxs = []
+
+        self.heap = 0
+        self.sums = dict.fromkeys(Space.cols[1:-1], 0)
+        self.tops = []
+        self.last = None
+        self.prev = None
+
+        # the rows, in memory or streamed to out with the one of the current bucket held back
+        self.rows = bytearray()
+        self.cur  = None
+        self.fo   = open(out, 'wb') if out else None
+
+    def __len__(self) -> int:
+        return len(self.rows) // Space.row.size
+
+    def __getitem__(self, k: int) -> dict[str, float]:
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError(k)
+
+        return dict(zip(Space.cols, Space.row.unpack_from(self.rows, k * Space.row.size)))
+
+    def acct(self, sz: int, prot: str, kind: str) -> None:
+        # sz is signed
+        self.sums['total'] += sz
+        self.sums['anon' if kind == 'a' else 'file'] += sz
+
+        for p in 'rwx':
+            if p in prot:
+                self.sums[p] += sz
+        if prot == '---':
+            self.sums['none'] += sz
+
+    def ins(self, lo: int) -> None:
+        if not self.keys:
+            self.keys.append([lo])
+            self.maxs.append(lo)
+            return
+
+        b = min(bisect.bisect_left(self.maxs, lo), len(self.keys) - 1)
+        s = self.keys[b]
+
+        bisect.insort(s, lo)
+        self.maxs[b] = s[-1]
+
+        if len(s) > 2 * Space.bkt:
+            self.keys[b:b + 1] = [s[:Space.bkt], s[Space.bkt:]]
+            self.maxs[b:b + 1] = [s[Space.bkt - 1], s[-1]]
+
+    def rem(self, lo: int) -> None:
+        b = bisect.bisect_left(self.maxs, lo)
+        s = self.keys[b]
+
+        del s[bisect.bisect_left(s, lo)]
+
+        if s:
+            self.maxs[b] = s[-1]
+        else:
+            del self.keys[b], self.maxs[b]
+
+    def span(self, lo: int, hi: int) -> list[int]:
+        # starts of the vmas overlapping [lo, hi), in order
+        b = bisect.bisect_left(self.maxs, lo)
+        k = bisect.bisect_left(self.keys[b], lo) if b < len(self.keys) else 0
+        ret = []
+
+        # the one starting below lo
+        if k:
+            p = self.keys[b][k - 1]
+        elif b:
+            p = self.keys[b - 1][-1]
+        else:
+            p = None
+
+        if p is not None and self.vmas[p][0] > lo:
+            ret.append(p)
+
+        while b < len(self.keys):
+            s = self.keys[b]
+
+            while k < len(s) and s[k] < hi:
+                ret.append(s[k])
+                k += 1
+
+            if k < len(s):
+                break
+
+            b, k = b + 1, 0
+
+        return ret
+
+    def cut(self, lo: int, hi: int) -> tuple[str, str] | None:
+        # remove [lo, hi), splitting partially covered vmas
+        ret = None
+
+        for a in self.span(lo, hi):
+            b, t = self.vmas.pop(a)
+            ret  = ret or t
+
+            self.rem(a)
+            self.acct(a - b, *t)
+
+            if a < lo:
+                self.put(a, lo, t)
+            if b > hi:
+                self.put(hi, b, t)
+
+        return ret
+
+    def put(self, lo: int, hi: int, t: tuple[str, str]) -> None:
+        self.vmas[lo] = hi, t
+        self.ins(lo)
+
+        self.acct(hi - lo, *t)
+
+        heapq.heappush(self.tops, (lo - hi, lo, hi))
+
+        if len(self.tops) > 2 * len(self.vmas) + 64:
+            self.tops = [(a - b, a, b) for a, (b, _) in self.vmas.items()]
+            heapq.heapify(self.tops)
+
+    def top(self) -> int:
+        # lazily drop the vmas that are gone
+        while self.tops:
+            _, lo, hi = self.tops[0]
+
+            if (v := self.vmas.get(lo)) and v[0] == hi:
+                return max(hi - lo, self.heap)
+
+            heapq.heappop(self.tops)
+
+        return self.heap
+
+    def __call__(self, cs: str) -> None:
+        sp = cs.split()
+
+        if len(sp) < 3:
+            return
+
+        t = float(sp[1])
+
+        match sp[0]:
+            case '+' | '-':
+                sz = int(sp[2], 16) * (1 if sp[0] == '+' else -1)
+
+                self.heap += sz
+                self.acct(sz, 'rw-', 'a')
+            case '*':
+                lo  = int(sp[2], 16)
+                hi  = lo + int(sp[3], 16)
+                old = self.cut(lo, hi)
+
+                if len(sp) > 5 and sp[4] != '-':
+                    self.put(lo, hi, (sp[4], sp[5]))
+                else:
+                    # mremap keeps the attributes of the moved vma
+                    self.put(lo, hi, self.prev or old or ('rw-', 'a'))
+            case '/':
+                lo  = int(sp[2], 16)
+                hi  = lo + int(sp[3], 16)
+
+                self.prev = self.cut(lo, hi)
+                self.push(t)
+                return
+            case '=':
+                lo  = int(sp[2], 16)
+                hi  = lo + int(sp[3], 16)
+                pcs = [(max(a, lo), min(self.vmas[a][0], hi), self.vmas[a][1][1]) for a in self.span(lo, hi)]
+
+                for a, b, k in pcs:
+                    self.cut(a, b)
+                    self.put(a, b, (sp[4] if len(sp) > 4 else 'rw-', k))
+
+        self.prev = None
+        self.push(t)
+
+    def push(self, t: float) -> None:
+        row = Space.row.pack(t, *self.sums.values(), self.top())
+
+        if self.last is not None and t - self.last < self.dly:
+            # keep only the latest state within a bucket
+            if self.fo:
+                self.cur = row
+            else:
+                self.rows[-Space.row.size:] = row
+            return
+
+        self.last = t
+
+        if self.fo:
+            if self.cur:
+                self.fo.write(self.cur)
+            self.cur = row
+        else:
+            self.rows += row
+
+    def close(self) -> None:
+        if self.fo:
+            if self.cur:
+                self.fo.write(self.cur)
+
+            self.fo.close()
+            self.fo  = None
+            self.cur = None
+
+    def feed(self, fn: str) -> Space:
+        with open(fn) as fi:
+            for cs in fi:
+                self(cs)
+
+        self.close()
+
+        return self
+
+    def at(self, t: float) -> dict[str, float] | None:
+        # state right after the last event at or before t
+        key = lambda k: Space.row.unpack_from(self.rows, k * Space.row.size)[0]
+
+        if (k := bisect.bisect_right(range(len(self)), t, key=key) - 1) < 0:
+            return None
+
+        return self[k]
+
+    def dump(self, fn: str) -> None:
+        with open(fn, 'wb') as fo:
+            fo.write(self.rows)
+
+    @staticmethod
+    def load(fn: str) -> Space:
+        # the rows are mapped, not read
+        ret = Space()
+
+        with open(fn, 'rb') as fi:
+            if os.fstat(fi.fileno()).st_size:
+                ret.rows = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return ret
@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import math
+
+
+# two-sided 95% student-t quantiles for 1..30 degrees of freedom
+T95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+        2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+        2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+COLS = ['n', 'med', 'p5', 'p95', 'mean', 'std', 'lo', 'hi']
+
+
+def pct(xs: list[float], p: float) -> float:
+    # xs is sorted, linear interpolation
+    if not xs:
+        return 0.0
+
+    k = (len(xs) - 1) * p
+    f = math.floor(k)
+    c = math.ceil (k)
+
+    return xs[f] + (xs[c] - xs[f]) * (k - f)
+
+
+def ci(xs: list[float]) -> tuple[float, float, float]:
+    n = len(xs)
+
+    if n == 0:
+        return 0.0, 0.0, 0.0
+
+    mean = sum(xs) / n
+
+    if n == 1:
+        return mean, 0.0, math.inf
+
+    std = math.sqrt(sum((x - mean) ** 2 for x in xs) / (n - 1))
+    t   = T95[n - 2] if n - 1 <= len(T95) else 1.960
+
+    return mean, std, t * std / math.sqrt(n)
+
+
+def rel(xs: list[float]) -> float:
+    mean, _, h = ci(xs)
+
+    try:
+        return h / abs(mean)
+    except ZeroDivisionError:
+        return 0.0 if h == 0.0 else math.inf
+
+
+def summ(xs: list[float]) -> list[float]:
+    ys = sorted(xs)
+
+    mean, std, h = ci(ys)
+
+    return [float(len(ys)),
+            pct(ys, 0.50),
+            pct(ys, 0.05),
+            pct(ys, 0.95),
+            mean,
+            std,
+            mean - h,
+            mean + h]
@@ -0,0 +1,183 @@
+from __future__ import annotations
+from   typing   import Any
+
+import os
+import json
+import array
+import socket
+import sqlite3
+
+from .Pipe import RUSE
+from .Cache import Cache
+from .Load import Load
+
+
+class Store(object):
+
+    # one row per run of a pipe, name is the case
+    schema = '''
+        CREATE TABLE IF NOT EXISTS runs   (id INTEGER PRIMARY KEY, name TEXT, pipe INTEGER, tag TEXT, host TEXT,
+                                           beg REAL, end REAL, args TEXT, env TEXT, wrap TEXT, status INTEGER, timeout INTEGER);
+        CREATE TABLE IF NOT EXISTS stages (run INTEGER, idx INTEGER, args TEXT, wall REAL, utime REAL, stime REAL,
+                                           maxrss INTEGER, minflt INTEGER, majflt INTEGER, nvcsw INTEGER, nivcsw INTEGER,
+                                           status INTEGER, timeout INTEGER, launch REAL);
+        CREATE TABLE IF NOT EXISTS attrs  (run INTEGER, key TEXT, value);
+        CREATE TABLE IF NOT EXISTS series (run INTEGER, stage INTEGER, name TEXT, cols INTEGER, data BLOB);
+
+        CREATE INDEX IF NOT EXISTS runs_name   ON runs   (name, pipe);
+        CREATE INDEX IF NOT EXISTS stages_run  ON stages (run);
+        CREATE INDEX IF NOT EXISTS attrs_key   ON attrs  (key, value, run);
+        CREATE INDEX IF NOT EXISTS series_name ON series (name, run);
+    '''
+
+    # rusage columns of a stage, see Pipe
+    cols = RUSE
+
+    def __init__(self, fn: str):
+        self.fn   = fn
+        self.host = socket.gethostname()
+        self.con  = sqlite3.connect(fn)
+        self.todo = []
+
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.execute('PRAGMA synchronous=NORMAL')
+        self.con.executescript(Store.schema)
+
+    @staticmethod
+    def attrs(p: Any) -> dict[str, Any]:
+        # the plain options, the items' over the case's over the exec's
+        ret = {}
+
+        for o in [p.case.exec, p.case, *p.subs]:
+            for k, v in vars(o).items():
+                if isinstance(v, (bool, int, float, str)) and not k.startswith('rt_') and k not in ('dir', 'name'):
+                    ret[k] = v
+
+        return ret
+
+    def put(self, p: Any, beg: float, end: float) -> None:
+        # from Pipe, after each run
+        res = p.res
+        cur = self.con.execute('INSERT INTO runs (name, pipe, tag, host, beg, end, args, env, wrap, status, timeout) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               (str(p.case), p.idx, p.tag, self.host, beg, end,
+                                json.dumps([s.args for s in p.subs]),
+                                json.dumps([Cache.norm(s.env) for s in p.subs]),
+                                json.dumps([Cache.norm(s.wrap) for s in p.subs]),
+                                max((r.get('status', 0) for r in res), key=abs, default=0),
+                                int(any(r.get('timeout', 0) for r in res))))
+        run = cur.lastrowid
+
+        self.con.executemany(f'INSERT INTO stages VALUES (?, ?, ?, {", ".join("?" * len(Store.cols))})',
+                             [(run, i, ' '.join(s.args), *(r.get(k, 0) for k in Store.cols)) for i, (s, r) in enumerate(zip(p.subs, res))])
+        self.con.executemany('INSERT INTO attrs VALUES (?, ?, ?)',
+                             [(run, k, v) for k, v in Store.attrs(p).items()])
+        self.con.commit()
+
+        # the wrappers' output, once it is post-processed
+        for i, s in enumerate(p.subs):
+            if s.wrap:
+                for w in s.wrap.flat():
+                    self.todo.append((run, i, p.dir, f'{p.case}-{p.tag}-{i}-', w.name, w.part))
+
+    def feed(self, fmt: dict[str, Any]) -> None:
+        # wrapper name -> fmt_* of its .post and .log lines or the name of a Load format, stored as float64 rows,
+        # {name}.{part} for the .{part}.post files of a split Perf, which are left out without one
+        fns = {}
+        add = []
+
+        for run, i, d, pfx, name, part in self.todo:
+            if name not in fmt and f'{name}.{part}' not in fmt:
+                continue
+
+            if d not in fns:
+                fns[d] = sorted(os.listdir(d))
+
+            for f in fns[d]:
+                if not f.startswith(pfx + name) or not f.endswith(('.post', '.log')):
+                    continue
+
+                if (fn := fmt.get(f'{name}.{part}' if part and f.endswith(f'.{part}.post') else name)) is None:
+                    continue
+
+                if isinstance(fn, str):
+                    try:
+                        cols, buf = Load.rows(Load(fn).file(os.path.join(d, f)))
+                    except ValueError as e:
+                        print(f'WARNING: {e}')
+                        continue
+
+                    if buf:
+                        add.append((run, i, f[len(pfx):], cols, buf))
+
+                    continue
+
+                buf  = array.array('d')
+                cols = 0
+
+                with open(os.path.join(d, f)) as fi:
+                    for k, cs in enumerate(fi):
+                        try:
+                            row = fn(k, cs)
+                        except (ValueError, IndexError):
+                            continue
+
+                        cols = len(row)
+                        buf.extend(row)
+
+                if cols:
+                    add.append((run, i, f[len(pfx):], cols, buf.tobytes()))
+
+        self.con.executemany('INSERT INTO series VALUES (?, ?, ?, ?, ?)', add)
+        self.con.commit()
+
+        self.todo = []
+
+    def where(self, case: str | None, kw: dict[str, Any]) -> tuple[str, list[Any]]:
+        sql = []
+        arg = []
+
+        if case is not None:
+            sql.append('r.name = ?')
+            arg.append(case)
+
+        for k, v in kw.items():
+            sql.append('r.id IN (SELECT run FROM attrs WHERE key = ? AND value = ?)')
+            arg.extend([k, v])
+
+        return ' AND '.join(sql) or '1', arg
+
+    def runs(self, case: str | None = None, **kw: Any) -> list[dict[str, Any]]:
+        sql, arg = self.where(case, kw)
+        cur      = self.con.execute(f'SELECT r.* FROM runs r WHERE {sql} ORDER BY r.id', arg)
+        key      = [d[0] for d in cur.description]
+
+        return [dict(zip(key, r)) for r in cur]
+
+    def stages(self, col: str, case: str | None = None, **kw: Any) -> list[tuple[int, int, float]]:
+        # (run, stage, value) of a rusage column
+        if col not in Store.cols:
+            raise ValueError(f'Store: unknown column {col}, one of {", ".join(Store.cols)}')
+
+        sql, arg = self.where(case, kw)
+
+        return self.con.execute(f'SELECT s.run, s.idx, s.{col} FROM stages s JOIN runs r ON r.id = s.run '
+                                f'WHERE {sql} ORDER BY s.run, s.idx', arg).fetchall()
+
+    def series(self, name: str, case: str | None = None, **kw: Any) -> list[tuple[int, int, int, array.array]]:
+        # (run, stage, cols, flat rows) of the series whose name matches, a LIKE pattern,
+        # compared with = without a wildcard as LIKE cannot use the index on the name
+        sql, arg = self.where(case, kw)
+        ret      = []
+        op       = 'LIKE' if '%' in name or '_' in name else '='
+
+        for run, i, cols, data in self.con.execute(f'SELECT s.run, s.stage, s.cols, s.data FROM series s JOIN runs r ON r.id = s.run '
+                                                   f'WHERE s.name {op} ? AND {sql} ORDER BY s.run, s.stage', [name] + arg):
+            buf = array.array('d')
+            buf.frombytes(data)
+            ret.append((run, i, cols, buf))
+
+        return ret
+
+    def close(self) -> None:
+        self.con.close()
@@ -0,0 +1,143 @@
+from __future__ import annotations
+from   typing   import Any
+
+import os
+import bz2
+import copy
+import lzma
+import zlib
+import collections
+
+
+class Tee(object):
+
+    # streaming compressors, by suffix
+    codecs = {'gz' : lambda: zlib.compressobj(6, zlib.DEFLATED, 31),
+              'bz2': bz2.BZ2Compressor,
+              'xz' : lzma.LZMACompressor}
+
+    def __init__(self, **kw: Any):
+        self.echo  = 0
+        self.codec = ''
+        self.ring  = 64
+        self.err   = 0
+
+        self.__dict__.update(kw)
+
+        if self.codec and self.codec not in Tee.codecs:
+            raise ValueError(f'Tee: unknown codec {self.codec}, one of {", ".join(Tee.codecs)}')
+
+        self.fn   = ''
+        self.r    = -1
+        self.w    = -1
+        self.fd   = -1
+        self.off  =  0
+        self.zip  = None
+        self.part = b''
+        self.subs = collections.deque(maxlen=self.ring)
+
+    def open(self, fn: str) -> Tee:
+        # a capture of one run, the last stage writes into w
+        ret = copy.copy(self)
+
+        ret.fn   = f'{fn}.{self.codec}' if self.codec else fn
+        ret.r, ret.w = os.pipe()
+        ret.fd   = os.open(ret.fn, os.O_RDWR | os.O_CREAT | os.O_TRUNC, mode=0o644)
+        ret.off  =  0
+        ret.zip  = Tee.codecs[self.codec]() if self.codec else None
+        ret.part = b''
+        ret.subs = collections.deque(maxlen=self.ring)
+
+        os.set_blocking(ret.r, False)
+
+        return ret
+
+    def pump(self) -> bool:
+        # whatever is in the pipe, true on eof
+        while True:
+            try:
+                if self.zip:
+                    buf = os.read(self.r, 1 << 16)
+                    num = len(buf)
+                else:
+                    # straight from the pipe into the page cache
+                    num = os.splice(self.r, self.fd, 1 << 16, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            except BlockingIOError:
+                return False
+
+            if not num:
+                return True
+
+            if self.zip:
+                Tee.write(self.fd, self.zip.compress(buf))
+                self.keep(buf)
+
+                if self.echo:
+                    Tee.write(self.echo, buf)
+            elif self.echo:
+                # back out of the page cache, never through here
+                off = self.off
+                while off < self.off + num:
+                    off += os.sendfile(self.echo, self.fd, off, self.off + num - off)
+
+            self.off += num
+
+    @staticmethod
+    def write(fd: int, buf: bytes) -> None:
+        mv = memoryview(buf)
+        while mv:
+            mv = mv[os.write(fd, mv):]
+
+    def keep(self, buf: bytes) -> None:
+        # complete lines into the ring, a runaway line is cut to its end
+        *ls, self.part = (self.part + buf).split(b'\n')
+        self.part = self.part[-(1 << 16):]
+
+        self.subs.extend(ls)
+
+    def close(self) -> None:
+        if self.r >= 0:
+            self.pump()
+
+            os.close(self.r)
+            self.r = -1
+
+        if self.w >= 0:
+            os.close(self.w)
+            self.w = -1
+
+        if self.fd >= 0:
+            if self.zip:
+                Tee.write(self.fd, self.zip.flush())
+
+            os.close(self.fd)
+            self.fd = -1
+
+    def tail(self, n: int = 0) -> list[str]:
+        # the last lines of the run, from the ring when compressing, otherwise from the end of the log
+        n = n or self.ring
+
+        if self.zip:
+            ls = list(self.subs) + ([self.part] if self.part else [])
+        else:
+            try:
+                with open(self.fn, 'rb') as fi:
+                    end = fi.seek(0, os.SEEK_END)
+                    blk = 1 << 16
+
+                    # back until there are enough lines or the start of the file
+                    while True:
+                        fi.seek(max(end - blk, 0))
+                        ls = fi.read(min(blk, end)).split(b'\n')
+
+                        if blk >= end or len(ls) > n + 1:
+                            break
+
+                        blk <<= 1
+            except FileNotFoundError:
+                return []
+
+            if ls and not ls[-1]:
+                ls.pop()
+
+        return [cs.decode(errors='replace') for cs in ls[-n:]]
@@ -0,0 +1,157 @@
+from __future__ import annotations
+from   typing   import Any
+
+import os
+import ctypes
+import platform
+
+
+class Topo(object):
+
+    root = os.path.join(os.sep, 'sys', 'devices', 'system')
+
+    # set_mempolicy(2)
+    SYS       = {'x86_64': 238, 'aarch64': 237}
+    MPOL_BIND = 2
+
+    def __init__(self, cpu: Any = None, **kw: Any):
+        self.root = Topo.root
+
+        self.__dict__.update(kw)
+
+        own = set(cpu if cpu else os.sched_getaffinity(0))
+        num = Topo.nodes(self.root)
+
+        # cpu -> (node, package, core, rank among its smt siblings)
+        self.subs = {}
+
+        for c in sorted(own):
+            fn = os.path.join(self.root, 'cpu', f'cpu{c}', 'topology')
+
+            try:
+                pkg = int(Topo.get(os.path.join(fn, 'physical_package_id')))
+                cor = int(Topo.get(os.path.join(fn, 'core_id')))
+                sib = Topo.span(Topo.get(os.path.join(fn, 'thread_siblings_list')))
+            except (OSError, ValueError):
+                pkg, cor, sib = 0, c, [c]
+
+            self.subs[c] = (next((n for n, cs in num.items() if c in cs), 0), pkg, cor, sib.index(c) if c in sib else 0)
+
+        self.res = []
+
+    @staticmethod
+    def get(fn: str) -> str:
+        with open(fn) as fi:
+            return fi.read().strip()
+
+    @staticmethod
+    def span(cs: str) -> list[int]:
+        # 0-3,8,10-11
+        ret = []
+
+        for r in filter(None, cs.split(',')):
+            lo, _, hi = r.partition('-')
+            ret.extend(range(int(lo), int(hi or lo) + 1))
+
+        return ret
+
+    @staticmethod
+    def fmt(cpu: Any) -> str:
+        return ','.join(map(str, sorted(cpu))) if cpu else '-'
+
+    @staticmethod
+    def nodes(root: str = '') -> dict[int, list[int]]:
+        # node -> cpus, a single node when the kernel has no numa
+        fn  = os.path.join(root or Topo.root, 'node')
+        ret = {}
+
+        try:
+            for d in os.listdir(fn):
+                if d.startswith('node') and d[4:].isdigit():
+                    ret[int(d[4:])] = Topo.span(Topo.get(os.path.join(fn, d, 'cpulist')))
+        except OSError:
+            pass
+
+        return ret or {0: sorted(os.sched_getaffinity(0))}
+
+    @staticmethod
+    def where(cpu: Any) -> set[int]:
+        # nodes of the cpus
+        return {n for n, cs in Topo.nodes().items() if set(cs) & set(cpu)}
+
+    @staticmethod
+    def mem(bind: Any, cpu: Any) -> set[int]:
+        # local is wherever the cpus are
+        if bind is None:
+            return set()
+        elif bind == 'local':
+            return Topo.where(cpu or os.sched_getaffinity(0))
+        elif isinstance(bind, int):
+            return {bind}
+        else:
+            return set(bind)
+
+    @staticmethod
+    def bind(node: set[int]) -> None:
+        # from the child, before the exec, the policy is inherited
+        if not node:
+            return
+
+        if (nr := Topo.SYS.get(platform.machine())) is None:
+            print(f'WARNING: Topo: no set_mempolicy on {platform.machine()}, memory is not bound')
+            return
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        mask = (ctypes.c_ulong * (max(node) // 64 + 1))()
+
+        for n in node:
+            mask[n // 64] |= 1 << (n % 64)
+
+        if libc.syscall(nr, Topo.MPOL_BIND, mask, ctypes.c_ulong(len(mask) * 64 + 1)) < 0:
+            print(f'WARNING: Topo: set_mempolicy: {os.strerror(ctypes.get_errno())}, memory is not bound')
+
+    def reserve(self, n: int) -> list[int]:
+        # whole cores off the end of the last node, so that the harness shares none of them with a stage
+        cor = []
+
+        for c in self.order('compact')[::-1]:
+            if (k := self.subs[c][:3]) not in cor:
+                cor.append(k)
+
+        if n >= len(cor):
+            print(f'WARNING: Topo: {len(cor)} cores, none is reserved for the harness')
+            return []
+
+        self.res = [c for c in self.order('compact') if self.subs[c][:3] in cor[:n]]
+
+        return self.res
+
+    def order(self, mode: str, node: int | None = None) -> list[int]:
+        # the cpus that are left, in the order the stages get them
+        cpu = [c for c in self.subs if c not in self.res]
+        key = self.subs
+
+        match mode:
+            case 'compact':
+                # smt siblings next to each other
+                return sorted(cpu, key=lambda c: key[c])
+            case 'nosmt':
+                return sorted((c for c in cpu if key[c][3] == 0), key=lambda c: key[c])
+            case 'spread':
+                # every core of every node before any of the siblings, the nodes taking turns
+                idx = {}
+                for c in sorted(cpu, key=lambda c: key[c]):
+                    idx.setdefault(key[c][:3], sum(k[0] == key[c][0] for k in idx))
+
+                return sorted(cpu, key=lambda c: (key[c][3], idx[key[c][:3]], key[c][0]))
+            case 'node':
+                if node is None:
+                    # the node with most of the cpus left
+                    num  = {}
+                    for c in cpu:
+                        num[key[c][0]] = num.get(key[c][0], 0) + 1
+                    node = max(num, key=lambda n: (num[n], -n))
+
+                return sorted((c for c in cpu if key[c][0] == node), key=lambda c: key[c])
+            case _:
+                raise ValueError(f'Topo: unknown placement {mode}, one of compact, spread, nosmt or node')
@@ -3,8 +3,17 @@ from   typing   import Any
 
 import os
 import re
+import math
+import mmap
 import time
+import array
+import heapq
+import bisect
+import select
 import signal
+import struct
+import subprocess
+import traceback
 
 import bcc
 import pickle
@@ -12,7 +21,7 @@ import pickle
 from .Item import Item
 
 
-__all__ = ['Wrap', 'STrace', 'MTrace', 'Perf', 'NVProf', 'WSS', 'BPF', 'fmt_perf_tlb', 'fmt_wss']
+__all__ = ['Wrap', 'STrace', 'MTrace', 'Perf', 'NVProf', 'WSS', 'BPF', 'Stack', 'fmt_perf_tlb', 'fmt_wss']
 
 
 def float_div(a: float, b: float) -> float:
@@ -55,11 +64,139 @@ def fmt_wss(i: int, cs: str) -> list[float]:
 class Wrap(object):
 
     def __init__(self, *a: str, **kw: Any):
+        self.name = 'wrap'
+        self.tree =  0
+        self.fn   = ''
+        self.peer =  0
+        # .post split by cpu or tid into .{part}.post next to it, see Perf
+        self.part = ''
+
+    def __call__(self, i: Item, d: str, m: str, n: int) -> bool:
+        # prep -> fork -> watch -> post, false in the child
+        if not self.prep(i, d, m, n):
+            return True
+
+        if (pid := self.fork()) == 0:
+            return False
+
+        try:
+            self.watch(pid)
+        except BaseException:
+            # a failed watcher may leave the child stopped and unreaped
+            for s in [signal.SIGKILL, signal.SIGCONT]:
+                try:
+                    self.sig(pid, s)
+                except ProcessLookupError:
+                    pass
+
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+            raise
+
+        # clean up
+        try:
+            self.sig(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+        # to the pool of the parent when there is one, a single write up to PIPE_BUF is atomic
+        if i.rt_post >= 0 and (job := self.jobs()) and len(buf := pickle.dumps((n, job))) + 4 <= select.PIPE_BUF:
+            os.write(i.rt_post, len(buf).to_bytes(4, 'little') + buf)
+        else:
+            self.fini()
+
+        return True
+
+    def kind(self) -> set[str]:
+        # args: prefixes the command line, env: sets the environment, watch: drives the child while it runs
+        return set()
+
+    def path(self, i: Item, d: str, m: str, n: int, ext: str) -> str:
+        return os.path.join(d, f'{i.case}-{m}-{n}-{self.name}.{ext}')
+
+    def prep(self, i: Item, d: str, m: str, n: int) -> bool:
+        return True
+
+    def watch(self, pid: int) -> None:
+        self.wait(pid)
+
+    def wait(self, pid: int, flags: int = 0) -> int:
+        # pid once it is gone, 0 while it runs with WNOHANG,
+        # a watcher sharing the child in a Stack is not its parent and only sees it exit
+        if not self.peer:
+            return os.waitpid(pid, flags)[0]
+
+        try:
+            fd = os.pidfd_open(pid)
+        except ProcessLookupError:
+            return pid
+
+        try:
+            return pid if select.select([fd], [], [], 0 if flags & os.WNOHANG else None)[0] else 0
+        finally:
+            os.close(fd)
+
+    def jobs(self) -> list[tuple[Wrap, str]]:
+        return [(self, self.fn)] if self.fn else []
+
+    def flat(self) -> list[Wrap]:
+        return [self]
+
+    def drop(self) -> None:
+        # closes what only the child and the watcher itself need, in the processes that only share the child
         pass
 
-    def __call__(self, i: Item, d: str, m: int, n: int) -> bool:
+    def fini(self) -> None:
+        for w, fn in self.jobs():
+            w.post(fn)
+
+    def post(self, fn: str) -> None:
         pass
 
+    def fork(self) -> int:
+        # with tree, the child leads its own process group so that its forks are signaled together
+        if (pid := os.fork()) == 0:
+            if self.tree:
+                os.setpgid(0, 0)
+            return 0
+
+        if self.tree:
+            try:
+                os.setpgid(pid, pid)
+            except (PermissionError, ProcessLookupError):
+                pass
+
+        return pid
+
+    def sig(self, pid: int, s: int) -> None:
+        if self.tree:
+            os.killpg(pid, s)
+        else:
+            os.kill  (pid, s)
+
+    @staticmethod
+    def kids(pid: int) -> list[int]:
+        # pid and all its descendants, through the children of every thread
+        ret = [pid]
+        k   = 0
+
+        while k < len(ret):
+            fn = os.path.join(os.sep, 'proc', str(ret[k]), 'task')
+
+            try:
+                for t in os.listdir(fn):
+                    with open(os.path.join(fn, t, 'children')) as fi:
+                        ret.extend(map(int, fi.read().split()))
+            except (FileNotFoundError, ProcessLookupError):
+                pass
+
+            k += 1
+
+        return ret
+
 
 class STrace(Wrap):
 
@@ -70,34 +207,45 @@ class STrace(Wrap):
         super().__init__(*a, **kw)
         self.name = 'strace'
         self.evts = 'trace=%memory'
+        self.mode = 'ptrace'
         self.__dict__.update(kw)
 
-    def __call__(self, i: Item, d: str, m: int, n: int) -> bool:
-        fn = os.path.join(d, f'{i.case}-{m}-{n}-{self.name}.log')
+        if self.mode == 'preload':
+            # see c/libstrace.c, glibc maps and grows the heaps of its other arenas internally,
+            # and its own mapped chunks are only seen when glibc's allocator comes right after the shim
+            print('WARNING: STrace: preload mode misses the mappings glibc makes internally for the heaps of non-main '
+                  'arenas, and those of large allocations when another allocator or malloc preload comes after '
+                  'libstrace.so, use ptrace mode for the full record set')
 
-        # strace doesn't work with an existing pipe
-        evt = ['-e', self.evts] if self.evts else []
+    def kind(self) -> set[str]:
+        return {'env'} if self.mode == 'preload' else {'args'}
 
-        i.rt_args = ['strace',
-                     '-T',
-                     '-ttt',
-                     '-o', fn] + evt + i.rt_args
+    def prep(self, i: Item, d: str, m: str, n: int) -> bool:
+        fn = self.path(i, d, m, n, 'log')
 
-        if (pid := os.fork()) == 0:
-            return False
+        if self.mode == 'preload':
+            # no ptrace stops, c/libstrace.so writes the .post records in-process
+            i.rt_env['LD_PRELOAD'  ] = os.path.join(os.path.dirname(__file__), 'c', 'libstrace.so')
+            i.rt_env['STRACE_TRACE'] = fn + '.post'
 
-        os.waitpid(pid, 0)
+            self.fn = ''
+        else:
+            # strace doesn't work with an existing pipe
+            evt = ['-e', self.evts] if self.evts else []
 
-        # clean up
-        try:
-            os.kill(pid, signal.SIGKILL)
-        except ProcessLookupError:
-            pass
+            i.rt_args = ['strace',
+                         '-T',
+                         '-ttt',
+                         '-o', fn] + evt + i.rt_args
 
-        self.post(fn)
+            self.fn = fn
 
         return True
 
+    @staticmethod
+    def prot(cs: str) -> str:
+        return ''.join(c if f'PROT_{p}' in cs else '-' for c, p in zip('rwx', ['READ', 'WRITE', 'EXEC']))
+
     def post(self, fn: str) -> None:
         brk = 0
 
@@ -119,77 +267,329 @@ class STrace(Wrap):
                             fo.write(f'{sig} {utc} {abs(dif):x}\n')
                         brk = new
                     case 'mmap':
-                        fo.write(f'* {utc} {ret} {int(args[1]):x}\n')
+                        kind = 'a' if 'MAP_ANONYMOUS' in args[3] else 'f'
+                        fo.write(f'* {utc} {ret} {int(args[1]):x} {STrace.prot(args[2])} {kind}\n')
                     case 'munmap':
                         fo.write(f'/ {utc} {args[0]} {int(args[1]):x}\n')
                     case 'mremap':
                         fo.write(f'/ {utc} {args[0]} {int(args[1]):x}\n')
-                        fo.write(f'* {utc} {ret} {int(args[2]):x}\n')
+                        fo.write(f'* {utc} {ret} {int(args[2]):x} - -\n')
                     case 'mprotect':
-                        fo.write(f'= {utc} {args[0]} {int(args[1]):x}\n')
+                        fo.write(f'= {utc} {args[0]} {int(args[1]):x} {STrace.prot(args[2])}\n')
 
 
 class MTrace(Wrap):
 
-    #                   ttt        func (args    )  =  ret
-    pat = re.compile(r'(\d+\.\d+) (\w+)\(([^)]+)\)( = (\w+))?')
+    # see c/libmtrace.c
+    magic = 0x3452544d
+    chunk = 0x4b43544d
+    calib = 0x4c43544d
+    hdr   = struct.Struct('<IIQQQQQ')
+    shm   = struct.Struct('<6Q64Q')
+    depth = 16
+
+    FREE     = 0
+    MALLOC   = 1
+    CALLOC   = 2
+    REALLOC  = 3
+    MEMALIGN = 4
+    TIME     = 0xff
 
     def __init__(self, *a: str, **kw: Any):
         super().__init__(*a, **kw)
-        self.name = 'mtrace'
+        self.name  = 'mtrace'
+        self.rate  =  0
+        self.min   =  0
+        self.clock = 'mono'
+        self.aggr  =  0
+        self.dly   =  0.01
+        self.stack =  0
+
         self.__dict__.update(kw)
 
-    def __call__(self, i: Item, d: str, m: int, n: int) -> bool:
-        fn = os.path.join(d, f'{i.case}-{m}-{n}-{self.name}.log')
+    def kind(self) -> set[str]:
+        return {'env', 'watch'} if self.aggr else {'env'}
 
-        # no time information...
-        i.rt_env['LD_PRELOAD'  ] = os.path.join(os.path.dirname(__file__), 'c', 'libmtrace.so')
-        i.rt_env['MALLOC_TRACE'] = fn
+    def prep(self, i: Item, d: str, m: str, n: int) -> bool:
+        fn = self.path(i, d, m, n, 'data')
 
-        if (pid := os.fork()) == 0:
-            return False
+        i.rt_env['LD_PRELOAD'        ] = os.path.join(os.path.dirname(__file__), 'c', 'libmtrace.so')
+        i.rt_env['MALLOC_TRACE'      ] = fn
+        i.rt_env['MALLOC_TRACE_RATE' ] = str(self.rate)
+        i.rt_env['MALLOC_TRACE_MIN'  ] = str(self.min)
+        i.rt_env['MALLOC_TRACE_CLOCK'] = self.clock
+        i.rt_env['MALLOC_TRACE_STACK'] = str(self.stack)
 
-        os.waitpid(pid, 0)
+        self.fn = fn
 
-        # clean up
-        try:
-            os.kill(pid, signal.SIGKILL)
-        except ProcessLookupError:
-            pass
+        if self.aggr:
+            # there is no trace to post-process
+            self.fn  = ''
+            self.seg = self.path(i, d, m, n, 'shm')
+
+            # sized up front so that it can be mapped before the child starts
+            with open(self.seg, 'wb') as fd:
+                fd.truncate(MTrace.shm.size)
 
-        self.post(fn)
+            i.rt_env['MALLOC_TRACE_SHM'] = self.seg
 
         return True
 
-    def post(self, fn: str) -> None:
-        dic = {}
+    def watch(self, pid: int) -> None:
+        if not self.aggr:
+            self.wait(pid)
+            return
 
-        with open(fn, 'r') as fi, open(fn + '.post', 'w') as fo:
+        fn = self.seg
+
+        # timeline of: time live peak allocs frees
+        with open(fn, 'r+b') as fd, mmap.mmap(fd.fileno(), MTrace.shm.size) as mm, \
+             open(fn[:-4] + '.log', 'w') as fo:
+            cur = time.time()
+
+            while True:
+                try:
+                    end = self.wait(pid, os.WNOHANG)
+                except ChildProcessError:
+                    end = pid
+
+                _, live, peak, na, nf, _, *_ = MTrace.shm.unpack_from(mm)
+
+                fo.write(f'{time.time() - cur:.3f} {live} {peak} {na} {nf}\n')
+
+                if end:
+                    break
+
+                time.sleep(self.dly)
+
+            # size classes: [2^k, 2^(k + 1))
+            _, _, _, _, _, _, *hist = MTrace.shm.unpack_from(mm)
+
+            with open(fn[:-4] + '.hist', 'w') as fo:
+                for k, v in enumerate(hist):
+                    if v:
+                        fo.write(f'{1 << k:x} {v}\n')
+
+    @staticmethod
+    def head(fn: str) -> tuple[int, int, int, int, int]:
+        # (wall clock in ns, ticks, sampling rate, size threshold, clock id)
+        with open(fn, 'rb') as fi:
+            magic, _, *hdr = MTrace.hdr.unpack(fi.read(MTrace.hdr.size))
+
+        if magic != MTrace.magic:
+            raise ValueError(f'{fn}: not a libmtrace trace')
+
+        return tuple(hdr)
+
+    @staticmethod
+    def load(fn: str):
+        # yields (ns, op, ptr, size, stack id), merged by time across threads
+        def gen(buf: memoryview, off: list[tuple[int, int, int]]):
+            for o, n, ts in off:
+                rec = buf[o:o + n * 3]
+
+                for hd, p, sz in zip(rec[0::3], rec[1::3], rec[2::3]):
+                    ts += hd >> 32
+
+                    if (op := hd & 0xff) == MTrace.TIME:
+                        ts += p
+                    else:
+                        yield ts, op, p, sz, hd >> 8 & 0xffffff
+
+        wall, tick, _, _, clock = MTrace.head(fn)
+
+        with open(fn, 'rb') as fi:
+            if os.fstat(fi.fileno()).st_size == MTrace.hdr.size:
+                return
+
+            with mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                end = (len(mm) - MTrace.hdr.size) // 8
+                buf = memoryview(mm)[MTrace.hdr.size:MTrace.hdr.size + end * 8].cast('Q')
+                tid = {}
+                cal = None
+                pos = 0
+
+                # index the chunks of every thread, each is in time order
+                while pos + 3 <= end:
+                    hd, n, ts = buf[pos:pos + 3]
+
+                    if   hd & 0xffffffff == MTrace.chunk:
+                        tid.setdefault(hd >> 32, []).append((pos + 3, min(n, (end - pos - 3) // 3), ts))
+                    elif hd & 0xffffffff == MTrace.calib and pos + 5 <= end:
+                        cal = buf[pos + 3], buf[pos + 4]
+                    else:
+                        raise ValueError(f'{fn}: corrupted chunk at {pos * 8 + MTrace.hdr.size}')
+
+                    pos += 3 + n * 3
+
+                # ticks to ns
+                if clock == 0:
+                    scale = 1
+                elif cal and cal[0] > tick:
+                    scale = (cal[1] - wall) / (cal[0] - tick)
+                else:
+                    raise ValueError(f'{fn}: tsc trace without calibration')
+
+                try:
+                    for ts, *r in heapq.merge(*(gen(buf, off) for off in tid.values())):
+                        yield wall + int((ts - tick) * scale), *r
+                finally:
+                    del buf
+
+    @staticmethod
+    def stacks(fn: str) -> dict[int, list[str]]:
+        # stack id -> frames, innermost first, symbolized once per unique address
+        with open(fn + '.stk', 'rb') as fi:
+            raw = array.array('Q', fi.read())
+
+        w   = MTrace.depth + 2
+        stk = {raw[k]: raw[k + 2:k + 2 + raw[k + 1]] for k in range(0, len(raw) - w + 1, w)}
+
+        # return addresses point past the call
+        sym = MTrace.symb(fn + '.maps', {pc - 1 for pcs in stk.values() for pc in pcs})
+
+        return {k: [sym[pc - 1] for pc in pcs] for k, pcs in stk.items()}
+
+    @staticmethod
+    def symb(fn: str, pcs: set[int]) -> dict[int, str]:
+        vma = []
+        obj = {}
+
+        with open(fn) as fi:
             for cs in fi:
-                if not (mat := MTrace.pat.match(cs)):
+                sp = cs.split(maxsplit=5)
+
+                if len(sp) < 6 or not sp[5].startswith('/'):
                     continue
 
-                utc  = mat.group(1)
-                func = mat.group(2)
-                args = mat.group(3).split(', ')
-                ret  = mat.group(5)
+                lo, hi = (int(x, 16) for x in sp[0].split('-'))
+                path   =  sp[5].strip()
 
-                match func:
-                    case 'free':
-                        if args[0] != '0':
-                            fo.write(f'- {utc} {args[0]} {dic.pop(args[0])}\n')
-                    case 'malloc':
-                        fo.write(f'+ {utc} {ret} {args[0]}\n')
-                        dic[ret] = args[0]
-                    case 'calloc':
-                        sz = int(args[0], 16) * int(args[1], 16)
-                        fo.write(f'+ {utc} {ret} {sz:x}\n')
-                        dic[ret] = f'{sz:x}'
-                    case 'realloc':
-                        if args[0] != '0':
-                            fo.write(f'- {utc} {args[0]} {dic.pop(args[0])}\n')
-                        fo.write(f'+ {utc} {ret} {args[1]}\n')
-                        dic[ret] = args[1]
+                vma.append((lo, hi, path))
+
+                if int(sp[2], 16) == 0:
+                    obj.setdefault(path, lo)
+
+        vma.sort()
+
+        los = [v[0] for v in vma]
+        sym = {pc: f'{pc:#x}' for pc in pcs}
+        req = {}
+
+        for pc in pcs:
+            if (k := bisect.bisect_right(los, pc) - 1) < 0 or pc >= vma[k][1]:
+                continue
+
+            path = vma[k][2]
+
+            try:
+                with open(path, 'rb') as fi:
+                    # ET_EXEC is linked at its final address
+                    base = 0 if fi.read(18)[16:18] == b'\x02\x00' else obj.get(path, vma[k][0])
+            except OSError:
+                continue
+
+            sym[pc] = f'{os.path.basename(path)}+{pc - base:#x}'
+            req.setdefault(path, []).append((pc, pc - base))
+
+        # one addr2line per object
+        for path, lst in req.items():
+            try:
+                out = subprocess.run(['addr2line', '-f', '-C', '-e', path] + [f'{o:#x}' for _, o in lst],
+                                     capture_output=True, text=True).stdout.splitlines()
+            except OSError:
+                break
+
+            for (pc, _), name in zip(lst, out[0::2]):
+                if name != '??':
+                    sym[pc] = name
+
+        return sym
+
+    def post(self, fn: str) -> None:
+        _, _, rate, _, _ = MTrace.head(fn)
+
+        dic = {}
+        top = 0
+        at  = 0
+        stk = os.path.isfile(fn + '.stk')
+
+        # stack id -> [bytes, count, live], bytes and count are estimates for the whole run when sampled
+        site = {}
+        live = 0
+
+        with open(fn + '.post', 'w') as fo:
+            for k, (ts, op, p, sz, sid) in enumerate(MTrace.load(fn)):
+                utc = f'{ts // 1000000000}.{ts // 1000 % 1000000:06d}'
+
+                if op == MTrace.FREE:
+                    if (v := dic.pop(p, None)) is not None:
+                        sz, sid = v
+                        fo.write(f'- {utc} {p:x} {sz:x}\n')
+
+                        if stk:
+                            live          -= sz
+                            site[sid][2] -= sz
+                    continue
+
+                # undo the sampling bias: an allocation of sz bytes is sampled with p = 1 - e^(-sz / rate),
+                # so each sample stands for 1 / p allocations of its size
+                w = 1 / -math.expm1(-sz / rate) if rate and sz else 1
+
+                if w != 1:
+                    sz = round(sz * w)
+
+                fo.write(f'+ {utc} {p:x} {sz:x}\n')
+                dic[p] = sz, sid
+
+                if stk:
+                    s     = site.setdefault(sid, [0, 0, 0])
+                    s[0] += sz
+                    s[1] += w
+                    s[2] += sz
+
+                    if (live := live + sz) > top:
+                        top, at = live, k
+
+        if stk:
+            self.site(fn, site, at)
+
+    def site(self, fn: str, site: dict[int, list[int]], at: int) -> None:
+        _, _, rate, _, _ = MTrace.head(fn)
+
+        # replay up to the peak for each site's share of it
+        dic = {}
+        top = {}
+
+        for k, (_, op, p, sz, sid) in enumerate(MTrace.load(fn)):
+            if k > at:
+                break
+
+            if op == MTrace.FREE:
+                if (v := dic.pop(p, None)) is not None:
+                    top[v[1]] -= v[0]
+                continue
+
+            if rate and sz:
+                sz = round(sz / -math.expm1(-sz / rate))
+
+            dic[p]   = sz, sid
+            top[sid] = top.get(sid, 0) + sz
+
+        frs = MTrace.stacks(fn)
+        fld = {}
+
+        with open(fn + '.site', 'w') as fo:
+            fo.write('# id bytes count live peak stack\n')
+
+            for sid, (b, c, l) in sorted(site.items(), key=lambda x: -x[1][0]):
+                cs = ';'.join(reversed(frs.get(sid, ['[unknown]'])))
+                fo.write(f'{sid} {b} {round(c)} {l} {top.get(sid, 0)} {cs}\n')
+                fld[cs] = fld.get(cs, 0) + b
+
+        with open(fn + '.folded', 'w') as fo:
+            for cs, b in fld.items():
+                fo.write(f'{cs} {b}\n')
 
 
 class Perf(Wrap):
@@ -211,22 +611,54 @@ class Perf(Wrap):
              'mem_load_retired.l2_miss',
              'mem_load_retired.l3_miss']
 
+    # see: tools/perf/Documentation/perf.data-file-format.txt
+    hdr = struct.Struct('<8sQQ6Q4Q')
+    rec = struct.Struct('<IHH')
+
+    # sample_type bits up to the period
+    S_IP         = 1 << 0
+    S_TID        = 1 << 1
+    S_TIME       = 1 << 2
+    S_ADDR       = 1 << 3
+    S_ID         = 1 << 6
+    S_CPU        = 1 << 7
+    S_PERIOD     = 1 << 8
+    S_STREAM_ID  = 1 << 9
+    S_IDENTIFIER = 1 << 16
+
+    R_SAMPLE         = 9
+    R_FINISHED_ROUND = 68
+
+    F_EVENT_DESC = 12
+
     def __init__(self, *a: str, **kw: Any):
         super().__init__(*a, **kw)
         self.name = 'perf'
         self.freq =  100
         self.dly  =  1.0
+        self.mode = 'record'
+        self.part = ''
+        self.r    = -1
+        self.w    = -1
 
         self.__dict__.update(kw)
 
         self.subs =  list(a) if a else Perf.ld_ch
 
-    def __call__(self, i: Item, d: str, m: int, n: int) -> bool:
+    def kind(self) -> set[str]:
+        return {'args', 'watch'} if self.mode == 'stat' else {'args'}
+
+    def prep(self, i: Item, d: str, m: str, n: int) -> bool:
         if len(self.subs) > 4:
             print(f'WARNING: Perf: simultaneously enabling {self.subs} events would lead to '
                             'PMC multiplexing and scaling, reducing accuracy')
 
-        fn = os.path.join(d, f'{i.case}-{m}-{n}-{self.name}.data')
+        fn = self.path(i, d, m, n, 'data')
+
+        if self.mode == 'stat':
+            self.fn  = ''
+            self.out = fn
+            return self.prep_stat(i)
 
         if len(self.subs):
             i.rt_args = ['perf',
@@ -238,42 +670,234 @@ class Perf(Wrap):
         else:
             print(f'WARNING: Perf: no events enabled')
 
-        # spawn perf-record
-        if (pid := os.fork()) == 0:
-            return False
+        self.fn = fn
 
-        os.waitpid(pid, 0)
+        return True
 
-        # clean up
-        try:
-            os.kill(pid, signal.SIGKILL)
-        except ProcessLookupError:
-            pass
+    def watch(self, pid: int) -> None:
+        if self.mode == 'stat':
+            self.stat(pid)
+        else:
+            self.wait(pid)
+
+    def prep_stat(self, i: Item) -> bool:
+        # interval counting, the counts stream straight into the .post file
+        r, w = os.pipe()
 
-        self.post(fn)
+        os.set_inheritable(w, True)
+
+        self.r = r
+        self.w = w
+
+        i.rt_args = ['perf',
+                     'stat',
+                     '-I', str(max(int(self.dly * 1000), 1)),
+                     '-x', ',',
+                     '--log-fd', str(w),
+                     '-e', ','.join(self.subs),
+                     '--'] + i.rt_args
 
         return True
 
+    def drop(self) -> None:
+        # the log pipe sees no EOF while any copy of its write end is open
+        if self.mode == 'stat' and self.w >= 0:
+            os.close(self.w)
+            self.w = -1
+
+    def stat(self, pid: int) -> None:
+        r, fn = self.r, self.out
+
+        self.drop()
+
+        prv = None
+        num = {e: 0 for e in self.subs}
+
+        # time,count,unit,event,...
+        with os.fdopen(r, 'r') as fi, open(f'{fn}.post', 'w') as fds:
+            for cs in fi:
+                sp = cs.strip().split(',')
+
+                if len(sp) < 4 or cs.startswith('#'):
+                    continue
+
+                if prv is not None and sp[0] != prv:
+                    fds.write(' '.join(map(str, num.values())) + '\n')
+                    num = dict.fromkeys(num, 0)
+
+                prv = sp[0]
+
+                if sp[3] in num:
+                    num[sp[3]] = int(sp[1]) if sp[1].isdigit() else 0
+
+            if prv is not None:
+                fds.write(' '.join(map(str, num.values())) + '\n')
+
+        self.wait(pid)
+
+    @staticmethod
+    def load(fn: str):
+        # yields (ns, event, period, cpu, tid) of every sample in perf-script order,
+        # the event is the attr index when the file has no names, cpu and tid are -1 when not sampled
+        with open(fn, 'rb') as fi, mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            _, _, asz, ao, an, do, dn, _, _, *feat = Perf.hdr.unpack_from(mm)
+
+            # attrs and their sample ids
+            ids = {}
+            sts = []
+
+            for k in range(an // asz):
+                o = ao + k * asz
+
+                sts.append(struct.unpack_from('<Q', mm, o + 24)[0])
+
+                io, isz = struct.unpack_from('<QQ', mm, o + asz - 16)
+
+                for v in struct.unpack_from(f'<{isz // 8}Q', mm, io):
+                    ids[v] = k
+
+            # names from the event_desc feature, which sits after the data
+            evt = {}
+            fo  = do + dn
+
+            for b in range(Perf.F_EVENT_DESC + 1):
+                if not feat[b // 64] >> (b % 64) & 1:
+                    continue
+
+                if b == Perf.F_EVENT_DESC:
+                    o, _ = struct.unpack_from('<QQ', mm, fo)
+                    nr, esz = struct.unpack_from('<II', mm, o)
+                    o += 8
+
+                    for k in range(nr):
+                        o += esz
+                        ni, sl = struct.unpack_from('<II', mm, o)
+                        name   = bytes(mm[o + 8:o + 8 + sl]).split(b'\0')[0].decode()
+                        o     += 8 + sl
+
+                        for v in struct.unpack_from(f'<{ni}Q', mm, o):
+                            evt[ids.get(v, k)] = name
+                        evt.setdefault(k, name)
+                        o += ni * 8
+
+                fo += 16
+
+            st  = sts[0]
+            pos = do
+            end = do + dn
+
+            # samples are only ordered across rounds, sort like perf's ordered_events
+            pend = []
+            lim  = 0
+            top  = 0
+
+            def flush(t: int):
+                nonlocal pend
+
+                pend.sort(key=lambda x: x[0])
+
+                k = bisect.bisect_right(pend, t, key=lambda x: x[0])
+
+                out, pend = pend[:k], pend[k:]
+
+                yield from out
+
+            while pos + 8 <= end:
+                ty, _, sz = Perf.rec.unpack_from(mm, pos)
+
+                if sz == 0:
+                    break
+
+                if ty == Perf.R_SAMPLE:
+                    o   = pos + 8
+                    sid = None
+                    t   = per = 0
+                    cpu = tid = -1
+
+                    if st & Perf.S_IDENTIFIER:
+                        sid = struct.unpack_from('<Q', mm, o)[0]; o += 8
+                    if st & Perf.S_IP:
+                        o += 8
+                    if st & Perf.S_TID:
+                        tid = struct.unpack_from('<I', mm, o + 4)[0]; o += 8
+                    if st & Perf.S_TIME:
+                        t   = struct.unpack_from('<Q', mm, o)[0]; o += 8
+                    if st & Perf.S_ADDR:
+                        o += 8
+                    if st & Perf.S_ID:
+                        sid = struct.unpack_from('<Q', mm, o)[0]; o += 8
+                    if st & Perf.S_STREAM_ID:
+                        o += 8
+                    if st & Perf.S_CPU:
+                        cpu = struct.unpack_from('<I', mm, o)[0]; o += 8
+                    if st & Perf.S_PERIOD:
+                        per = struct.unpack_from('<Q', mm, o)[0]
+
+                    k = ids.get(sid, 0)
+
+                    pend.append((t, evt.get(k, k), per, cpu, tid))
+                    top = max(top, t)
+
+                elif ty == Perf.R_FINISHED_ROUND:
+                    yield from flush(lim)
+                    lim = top
+
+                pos += sz
+
+            yield from flush(1 << 64)
+
     def post(self, fn: str) -> None:
-        r, w = os.pipe()
+        with open(fn, 'rb') as fi:
+            if fi.read(8) != b'PERFILE2':
+                return self.script(fn)
 
-        if (pid := os.fork()) == 0:
-            args = ['perf',
-                    'script',
-                    '-i', fn,
-                    '-F', '-comm,-tid,-ip']
-            os.close (r)
-            os.dup2  (w, 1)
-            os.execvp(args[0], args)
+        prv =  None
+        nil = {e: 0 for e in self.subs}
+        num = {e: 0 for e in self.subs}
+        key = {}
+        idx =  0
+
+        with open(f'{fn}.post', 'w') as fds, \
+             open(f'{fn}.{self.part}.post', 'w') if self.part else open(os.devnull, 'w') as fdp:
+            for ns, evt, per, cpu, tid in Perf.load(fn):
+                # as printed by perf script
+                cur = (ns // 1000) / 1e6
 
-        os.close(w)
+                if isinstance(evt, int):
+                    evt = self.subs[evt]
+
+                num[evt] += per
+
+                if self.part:
+                    k = cpu if self.part == 'cpu' else tid
+                    key.setdefault(k, dict(nil))[evt] += per
+
+                if prv is None:
+                    prv = cur
+                if (cur - prv) >= self.dly:
+                    prv = cur
+                    fds.write(' '.join(map(str, num.values())) + '\n')
+                    num.update(nil)
+
+                    # bucket cpu|tid counts...
+                    for k, v in sorted(key.items()):
+                        fdp.write(f'{idx} {k} ' + ' '.join(map(str, v.values())) + '\n')
+
+                    key = {}
+                    idx += 1
+
+    def script(self, fn: str) -> None:
+        args = ['perf',
+                'script',
+                '-i', fn,
+                '-F', '-comm,-tid,-ip']
 
         prv =  None
         nil = {e: 0 for e in self.subs}
         num = {e: 0 for e in self.subs}
 
-        with os.fdopen(r, 'r') as fi, open(f'{fn}.post', 'w') as fds:
-            for cs in fi:
+        with subprocess.Popen(args, stdout=subprocess.PIPE, text=True) as sub, open(f'{fn}.post', 'w') as fds:
+            for cs in sub.stdout:
                 sp  = cs.split()
                 cur = float(sp[0][:-1])
                 evt =       sp[2][:-1]
@@ -287,11 +911,6 @@ class Perf(Wrap):
                     fds.write(' '.join(map(str, num.values())) + '\n')
                     num.update(nil)
 
-        try:
-            os.kill(pid, signal.SIGKILL)
-        except ProcessLookupError:
-            pass
-
 
 class NVProf(Wrap):
 
@@ -302,27 +921,17 @@ class NVProf(Wrap):
         self.name = 'nvprof'
         self.__dict__.update(kw)
 
-    def __call__(self, i: Item, d: str, m: int, n: int) -> bool:
-        fn = os.path.join(d, f'{i.case}-{m}-{n}-{self.name}.log')
+    def kind(self) -> set[str]:
+        return {'args'}
+
+    def prep(self, i: Item, d: str, m: str, n: int) -> bool:
+        self.fn = self.path(i, d, m, n, 'log')
 
         i.rt_args = ['nvprof',
                      '--print-api-trace',
                      '--print-gpu-trace',
                      '--track-memory-allocations', 'on',
-                     '--log-file', fn] + i.rt_args
-
-        if (pid := os.fork()) == 0:
-            return False
-
-        os.waitpid(pid, 0)
-
-        # clean up
-        try:
-            os.kill(pid, signal.SIGKILL)
-        except ProcessLookupError:
-            pass
-
-        self.post(fn)
+                     '--log-file', self.fn] + i.rt_args
 
         return True
 
@@ -356,82 +965,405 @@ class NVProf(Wrap):
 
 class WSS(Wrap):
 
+    pat  = re.compile(rb'^(Rss|Pss|Referenced):\s+(\d+)', re.M)
+    vpat = re.compile(rb'^([0-9a-f]+)-[0-9a-f]+ (\S+) ([0-9a-f]+) \S+ \d+ *(.*)$|^(Rss|Pss|Referenced):\s+(\d+)', re.M)
+
+    # per-vma sample: time, interval, number of (region, rss, ref) triples
+    vhdr = struct.Struct('<ddI')
+
+    page = mmap.PAGESIZE.bit_length() - 1
+
+    # pagemap entry
+    PM_PRESENT = 1 << 63
+    PM_PFN     = (1 << 55) - 1
+
     def __init__(self, *a: str, **kw: Any):
         super().__init__(*a, **kw)
+        self.name = 'wss'
         self.max  = -1
         self.dly  =  0.01
         self.mode =  1
         self.stop =  1
         self.prof =  0
+        self.src  = 'rollup'
+        self.vma  =  0
+        self.tree =  0
+        self.each =  0
 
         self.__dict__.update(kw)
 
-    def __call__(self, i: Item, d: str, m: int, n: int) -> bool:
+        # per-vma mode reads smaps, only worth telling when another source was asked for
+        if self.vma and kw.get('src', 'smaps') != 'smaps':
+            print(f'WARNING: WSS: per-vma mode reads smaps instead of {self.src}')
+
+        self.buf  = bytearray(1 << 16)
+
+        # stable region ids across samples
+        self.ids  = {}
+
+    def read(self, fd: int) -> memoryview:
+        # whole file into the reused buffer, grown for large smaps,
+        # empty when the fd still points to the mm before an exec
+        pos = 0
+
+        while True:
+            if pos == len(self.buf):
+                self.buf.extend(bytes(len(self.buf)))
+
+            try:
+                with memoryview(self.buf) as mv:
+                    if (got := os.preadv(fd, [mv[pos:]], pos)) <= 0:
+                        break
+            except ProcessLookupError:
+                pos = 0
+                break
+
+            pos += got
+
+        return memoryview(self.buf)[:pos]
+
+    def smaps(self, fd: int) -> tuple[int, int, int] | None:
+        num = {b'Rss': 0, b'Pss': 0, b'Referenced': 0}
+
+        with self.read(fd) as mv:
+            if not mv:
+                return None
+
+            for k, v in WSS.pat.findall(mv):
+                num[k] += int(v)
+
+        return num[b'Rss'], num[b'Pss'], num[b'Referenced']
+
+    def vmas(self, fd: int, pfx: bytes = b'') -> tuple[tuple[int, int, int], array.array] | None:
+        # totals and (region, rss, ref) of every vma, pfx tells the processes apart
+        num = {b'Rss': 0, b'Pss': 0, b'Referenced': 0}
+        ret = array.array('I')
+
+        with self.read(fd) as mv:
+            if not mv:
+                return None
+
+            for lo, perm, off, path, k, v in WSS.vpat.findall(mv):
+                if not k:
+                    # named pseudo mappings move, heap and stack included
+                    if   path.startswith(b'['):
+                        key = path
+                    elif path:
+                        key = b'%s:%s:%s' % (path, off, perm)
+                    else:
+                        key = b'anon:%s:%s' % (lo, perm)
+
+                    ret.extend((self.ids.setdefault(pfx + key, len(self.ids)), 0, 0))
+                elif k != b'Pss':
+                    ret[-2 if k == b'Rss' else -1] = int(v)
+
+                if k:
+                    num[k] += int(v)
+
+        return (num[b'Rss'], num[b'Pss'], num[b'Referenced']), ret
+
+    @staticmethod
+    def heat(fn: str, col: str = 'ref') -> tuple[array.array, list[str], list[array.array]]:
+        # time x region matrix of rss or ref in kB, from the .vma file and its .keys
+        with open(f'{fn}.keys') as fi:
+            keys = fi.read().splitlines()
+
+        ts   = array.array('d')
+        rows = []
+        c    = 1 if col == 'rss' else 2
+
+        with open(fn, 'rb') as fi, mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = 0
+
+            while pos < len(mm):
+                t, _, n = WSS.vhdr.unpack_from(mm, pos)
+                pos    += WSS.vhdr.size
+
+                vs = array.array('I')
+                vs.frombytes(mm[pos:pos + n * 12])
+                pos += n * 12
+
+                row = array.array('q', bytes(8 * len(keys)))
+
+                for k in range(0, len(vs), 3):
+                    row[vs[k]] += vs[k + c]
+
+                ts  .append(t)
+                rows.append(row)
+
+        return ts, keys, rows
+
+    @staticmethod
+    def runs(xs: list[int]):
+        # (first, count) of the consecutive runs in sorted xs
+        k = 0
+
+        while k < len(xs):
+            j = k + 1
+
+            while j < len(xs) and xs[j] == xs[j - 1] + 1:
+                j += 1
+
+            yield xs[k], j - k
+
+            k = j
+
+    def scan(self, fd_maps: int, fd_pm: int) -> list[int] | None:
+        # pfns of every present page
+        pfn = []
+
+        with self.read(fd_maps) as mv:
+            if not mv:
+                return None
+
+            ls = bytes(mv).splitlines()
+
+        for cs in ls:
+            lo, hi = (int(x, 16) >> WSS.page for x in cs.split(None, 1)[0].split(b'-'))
+
+            # vsyscall is not in the page tables
+            if cs.endswith(b'[vsyscall]'):
+                continue
+
+            pm = array.array('Q')
+            pm.frombytes(os.pread(fd_pm, (hi - lo) * 8, lo * 8))
+
+            pfn.extend(e & WSS.PM_PFN for e in pm if e & WSS.PM_PRESENT)
+
+        return sorted(set(pfn))
+
+    @staticmethod
+    def pss(fd_cnt: int, pfn: list[int]) -> float:
+        ret = 0.0
+
+        for lo, n in WSS.runs(pfn):
+            cnt = array.array('Q')
+            cnt.frombytes(os.pread(fd_cnt, n * 8, lo * 8))
+
+            ret += sum(1 / c for c in cnt if c)
+
+        return ret
+
+    @staticmethod
+    def idle(fd_idle: int, pfn: list[int], mark: bool) -> int:
+        # mark the pages idle, or count the ones referenced since they were marked
+        msk = {}
+        ret = 0
+
+        for p in pfn:
+            msk[p >> 6] = msk.get(p >> 6, 0) | 1 << (p & 63)
+
+        ws = sorted(msk)
+
+        for lo, n in WSS.runs(ws):
+            if mark:
+                os.pwrite(fd_idle, array.array('Q', [msk[lo + k] for k in range(n)]).tobytes(), lo * 8)
+            else:
+                bit = array.array('Q')
+                bit.frombytes(os.pread(fd_idle, n * 8, lo * 8))
+
+                ret += sum((msk[lo + k] & ~b).bit_count() for k, b in enumerate(bit))
+
+        return ret
+
+    def open(self, pid: int, src: str) -> dict[str, int]:
+        # opened once, read with pread from then on
+        fn  = lambda f: os.path.join(os.sep, 'proc', str(pid), f)
+        ret = {}
+
+        try:
+            if src == 'pagemap':
+                ret['maps' ] = os.open(fn('maps'   ), os.O_RDONLY)
+                ret['pm'   ] = os.open(fn('pagemap'), os.O_RDONLY)
+            else:
+                if src == 'rollup' and os.path.exists(fn('smaps_rollup')):
+                    ret['smaps'] = os.open(fn('smaps_rollup'), os.O_RDONLY)
+                else:
+                    ret['smaps'] = os.open(fn('smaps'),        os.O_RDONLY)
+
+                ret['clear'] = os.open(fn('clear_refs'), os.O_WRONLY)
+        except OSError as e:
+            # a fork that is already gone is not worth a warning
+            if not isinstance(e, (FileNotFoundError, ProcessLookupError)):
+                print(f'WARNING: WSS: {e}')
+
+            for f in ret.values():
+                os.close(f)
+
+            ret = {}
+
+        return ret
+
+    def follow(self, fds: dict[int, dict[str, int]], pid: int, src: str) -> None:
+        now = set(Wrap.kids(pid))
+
+        for p in fds.keys() - now:
+            for f in fds.pop(p).values():
+                os.close(f)
+
+        for p in now - fds.keys():
+            if fd := self.open(p, src):
+                fds[p] = fd
+
+    def kind(self) -> set[str]:
+        return {'watch'}
+
+    def prep(self, i: Item, d: str, m: str, n: int) -> bool:
+        self.out = os.path.join(d, f'{i.case}-{m}-{n}-{self.name}')
+        return True
+
+    def watch(self, pid: int) -> None:
         def gen(a: int):
             t = 1
             while t < a:
                 yield t
                 t <<= 1
 
-        if (pid := os.fork()) == 0:
-            return False
-
         # stop it first
         if self.stop:
-            os.kill(pid, signal.SIGSTOP)
+            self.sig(pid, signal.SIGSTOP)
+
+        src = 'smaps' if self.vma else self.src
+        glb = {}
+
+        if src == 'pagemap':
+            try:
+                glb['cnt' ] = os.open('/proc/kpagecount',                os.O_RDONLY)
+                glb['idle'] = os.open('/sys/kernel/mm/page_idle/bitmap', os.O_RDWR)
+            except OSError as e:
+                print(f'WARNING: WSS: {e}, falling back to smaps_rollup')
 
-        fn_clear_refs = os.path.join(os.sep, 'proc', str(pid), 'clear_refs')
-        fn_smaps      = os.path.join(os.sep, 'proc', str(pid), 'smaps')
+                for f in glb.values():
+                    os.close(f)
+
+                src = 'rollup'
+                glb = {}
+
+        # per process
+        fds = {pid: fd} if (fd := self.open(pid, src)) else {}
+        pfn = {}
+        kb  = mmap.PAGESIZE // 1024
 
         # floats
-        fds = {t: open(os.path.join(d, f'{i.case}-{m}-{n}-wss-{t * self.dly:.2f}.log'), 'w')
+        fdw = {t: open(f'{self.out}-{t * self.dly:.2f}.log', 'w')
                   for t in gen(1 / self.dly if self.prof else 2)}
         cnt = 0
         dly = self.dly
+        vma = open(f'{self.out}.vma',  'wb') if self.vma  else None
+        one = open(f'{self.out}.each', 'w' ) if self.each else None
+        beg = time.time()
+        self.ids = {}
 
-        while self.max < 0 or cnt < self.max:
+        while pid in fds and (self.max < 0 or cnt < self.max):
             cnt += 1
             dif  = dly
-            rss  = 0
-            pss  = 0
-            ref  = 0
 
             try:
-                # clear all the access bits of the child
-                with open(fn_clear_refs, 'w') as fd:
-                    fd.write(str(self.mode))
+                ovh = time.perf_counter()
+
+                # the tree is rediscovered on every sample
+                if self.tree:
+                    self.follow(fds, pid, src)
+
+                # clear all the access bits of the children
+                if src == 'pagemap':
+                    pfn = {p: pfn[p] if p in pfn else self.scan(fd['maps'], fd['pm']) or [] for p, fd in fds.items()}
+
+                    WSS.idle(glb['idle'], sorted(set().union(*pfn.values())), True)
+                else:
+                    for fd in fds.values():
+                        os.write(fd['clear'], str(self.mode).encode())
+
+                ovh = time.perf_counter() - ovh
             except PermissionError:
                 break
 
             try:
                 if self.stop:
-                    os.kill(pid, signal.SIGCONT)
+                    self.sig(pid, signal.SIGCONT)
                     dif = time.time()
                 time.sleep(dly)
                 if self.stop:
-                    os.kill(pid, signal.SIGSTOP)
+                    self.sig(pid, signal.SIGSTOP)
                     dif = time.time() - dif
             except ProcessLookupError:
                 break
 
             try:
+                ovh -= time.perf_counter()
+                num  = {}
+                vs   = array.array('I')
+                pfn  = {}
+
                 # read rss/pss/ref
-                with open(fn_smaps) as fd:
-                    for cs in fd:
-                        if   cs.startswith('Rss:'):
-                            rss += int(cs.split()[1])
-                        elif cs.startswith('Pss:'):
-                            pss += int(cs.split()[1])
-                        elif cs.startswith('Referenced:'):
-                            ref += int(cs.split()[1])
+                for p, fd in fds.items():
+                    if src == 'pagemap':
+                        # pages faulted in during the interval were never marked, and count as referenced
+                        if (r := self.scan(fd['maps'], fd['pm'])) is not None:
+                            pfn[p] = r
+                    elif vma:
+                        if (r := self.vmas(fd['smaps'], b'%d:' % p if self.each else b'')) is not None:
+                            r, v = r
+                            vs.extend(v)
+                    else:
+                        r = self.smaps(fd['smaps'])
+
+                    if r is not None:
+                        num[p] = r
+
+                if src == 'pagemap' and pfn:
+                    if not any(any(v) for v in pfn.values()):
+                        print('WARNING: WSS: pagemap hides the pfns, CAP_SYS_ADMIN is needed')
+                        break
+
+                    for p, v in pfn.items():
+                        num[p] = (len(v) * kb,
+                                  int(WSS.pss(glb['cnt'], v) * kb),
+                                  WSS.idle(glb['idle'], v, False) * kb) if one else None
+
+                    # shared pages are counted once
+                    v   = sorted(set().union(*pfn.values()))
+                    tot = (len(v) * kb,
+                           int(WSS.pss(glb['cnt'], v) * kb),
+                           WSS.idle(glb['idle'], v, False) * kb)
+                else:
+                    tot = tuple(map(sum, zip(*num.values()))) or (0, 0, 0)
+
+                ovh += time.perf_counter()
             except PermissionError:
                 break
 
+            # the files were opened before an exec, or the process is gone
+            for p in fds.keys() - num.keys():
+                for f in fds.pop(p).values():
+                    os.close(f)
+
+                if p == pid and self.wait(pid, os.WNOHANG):
+                    continue
+                if fd := self.open(p, src):
+                    fds[p] = fd
+
+            if pid not in num:
+                cnt -= 1
+                continue
+
+            rss, pss, ref = tot
+
             # caveat: the time or performance is not accurate
             #   kernel's pte traversal definitely evict application's working set in the cache hierarchies,
             #   and the tlb entries are also flushed so that application experiences more ptw
             #   the reduced performance also makes the number of referenced pages smaller
-            fds[round(dif / self.dly)].write(f'{rss} {pss} {ref}\n')
+            # the last column is the time spent in the sampler itself
+            # the measured interval is off by the signals and the sampling itself, to the nearest one of the logs
+            fdw[min(fdw, key=lambda t: abs(t - dif / self.dly))].write(f'{rss} {pss} {ref} {ovh:.6f}\n')
+
+            if vma:
+                vma.write(WSS.vhdr.pack(time.time() - beg, dif, len(vs) // 3))
+                vs.tofile(vma)
+
+            if one:
+                for p, r in sorted(num.items()):
+                    one.write(f'{time.time() - beg:.6f} {p} ' + ' '.join(map(str, r)) + '\n')
 
             # next iteration
             if self.prof:
@@ -439,16 +1371,22 @@ class WSS(Wrap):
             if dly > 1 or not self.prof:
                 dly  = self.dly
 
-        # clean up
-        try:
-            os.kill(pid, signal.SIGKILL)
-        except ProcessLookupError:
-            pass
-
-        for f in fds.values():
+        for f in fdw.values():
             f.close()
 
-        return True
+        for fd in [glb, *fds.values()]:
+            for f in fd.values():
+                os.close(f)
+
+        if one:
+            one.close()
+
+        if vma:
+            vma.close()
+
+            with open(f'{vma.name}.keys', 'w') as fo:
+                for k in self.ids:
+                    fo.write(k.decode(errors='replace') + '\n')
 
 
 class BPF(Wrap):
@@ -462,41 +1400,42 @@ class BPF(Wrap):
         self.prog      = ''
         self.kprobe    = {}
         self.kretprobe = {}
+        self.tree      =  0
+        self.pid       =  0
 
         self.__dict__.update(kw)
 
         if self.prog and not os.path.isfile(self.prog):
             self.prog = os.path.join(BPF.root, self.prog)
 
-    def __call__(self, i: Item, d: str, m: int, n: int) -> bool:
-        fn = os.path.join(d, f'{i.case}-{m}-{n}-{self.name}.log')
+    def kind(self) -> set[str]:
+        return {'watch'}
 
+    def prep(self, i: Item, d: str, m: str, n: int) -> bool:
         if not self.prog:
             print('WARNING: BPF: no program specified')
-            return True
-
-        if (pid := os.fork()) == 0:
             return False
 
+        self.out = self.path(i, d, m, n, 'log')
+
+        return True
+
+    def watch(self, pid: int) -> None:
         # stop it first
         if self.stop:
-            os.kill(pid, signal.SIGSTOP);
+            self.sig(pid, signal.SIGSTOP)
+
+        # the program can filter on it, it is also the process group with tree
+        self.pid = pid
 
         # signal doesn't work for the elevated process
         fr, fw = os.pipe()
         br, bw = os.pipe()
 
-        if not os.fork():
-            os.close(fw)
-            os.close(br)
-            os.dup2 (fr, 0)
-            os.dup2 (bw, 1)
-
-            # elevate
-            os.execlp('sudo',
-                      'sudo',
-                      '--preserve-env=PYTHONPATH',
-                       os.path.join(BPF.root, 'BPF.py'))
+        # elevate
+        sub = subprocess.Popen(['sudo',
+                                '--preserve-env=PYTHONPATH',
+                                 os.path.join(BPF.root, 'BPF.py')], stdin=fr, stdout=bw)
 
         os.close(fr)
         os.close(bw)
@@ -509,13 +1448,13 @@ class BPF(Wrap):
         os.read (br, 1)
 
         if self.stop:
-            os.kill(pid, signal.SIGCONT);
+            self.sig(pid, signal.SIGCONT)
 
-        os.waitpid(pid, 0);
+        self.wait(pid)
 
-        # clean up
+        # clean up, forks that outlive the child included
         try:
-            os.kill(pid, signal.SIGKILL)
+            self.sig(pid, signal.SIGKILL)
         except ProcessLookupError:
             pass
 
@@ -524,7 +1463,7 @@ class BPF(Wrap):
         os.close(fw)
 
         # dump results
-        with open(fn, 'wb') as fd:
+        with open(self.out, 'wb') as fd:
             while True:
                 if buf := os.read(br, 4096):
                     fd.write(buf)
@@ -532,7 +1471,7 @@ class BPF(Wrap):
                     break
         os.close(br)
 
-        return True
+        sub.wait()
 
     def priv(self) -> None:
         bpf = bcc.BPF(src_file = self.prog.encode('utf-8'))
@@ -557,3 +1496,108 @@ class BPF(Wrap):
 
     def post(self, bpf: bcc.BPF) -> None:
         pass
+
+
+class Stack(Wrap):
+
+    def __init__(self, *a: Wrap, **kw: Any):
+        super().__init__(**kw)
+        self.name = 'stack'
+        self.subs = list(a)
+        self.live = []
+
+        self.__dict__.update(kw)
+
+        # one command line prefix, any number of preloads and watchers
+        if len(ws := [w for w in self.subs if 'args' in w.kind()]) > 1:
+            raise ValueError(f'Stack: {" and ".join(w.name for w in ws)} would all take args')
+
+    def __repr__(self) -> str:
+        return '+'.join(w.name for w in self.subs)
+
+    def kind(self) -> set[str]:
+        return set().union(*(w.kind() for w in self.subs))
+
+    def prep(self, i: Item, d: str, m: str, n: int) -> bool:
+        env = dict(i.rt_env)
+
+        self.live = []
+
+        # the prefix goes last so that it wraps everything else
+        for w in sorted(self.subs, key=lambda w: 'args' in w.kind()):
+            if 'args' in w.kind():
+                # the preloads are for the target, not for the tracer
+                if add := {k: v for k, v in i.rt_env.items() if env.get(k) != v}:
+                    i.rt_args = ['env'] + [f'{k}={v}' for k, v in add.items()] + i.rt_args
+                    i.rt_env  = dict(env)
+
+                if any('watch' in v.kind() and not v.tree for v in self.subs if v is not w):
+                    print(f'WARNING: Stack: the target runs under {w.name}, enable tree to watch it')
+
+            lib = i.rt_env.get('LD_PRELOAD', '')
+
+            if not w.prep(i, d, m, n):
+                continue
+
+            # chained, not replaced
+            if lib and (new := i.rt_env.get('LD_PRELOAD', '')) != lib:
+                i.rt_env['LD_PRELOAD'] = f'{lib}:{new}'
+
+            self.live.append(w)
+
+        if not self.live:
+            return False
+
+        # the watchers decide how the child is signaled
+        self.tree = max((w.tree for w in self.live if 'watch' in w.kind()), default=0)
+
+        return True
+
+    def watch(self, pid: int) -> None:
+        ws  = [w for w in self.live if 'watch' in w.kind()]
+        sub = []
+
+        # the first watcher reaps the child, the others watch it from forks of their own
+        # caveat: their stop and continue signals interleave, a WSS sample may be cut short
+        for w in ws[1:]:
+            if (p := os.fork()) == 0:
+                try:
+                    for v in ws:
+                        if v is not w:
+                            v.drop()
+
+                    w.peer = 1
+                    w.watch(pid)
+                except BaseException:
+                    traceback.print_exc()
+                finally:
+                    os._exit(0)
+
+            sub.append(p)
+
+        for w in ws[1:]:
+            w.drop()
+
+        try:
+            if ws:
+                ws[0].watch(pid)
+            else:
+                self.wait(pid)
+        except BaseException:
+            # the child is cleaned up by __call__
+            for p in sub:
+                try:
+                    os.kill(p, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+            raise
+        finally:
+            for p in sub:
+                os.waitpid(p, 0)
+
+    def jobs(self) -> list[tuple[Wrap, str]]:
+        return [j for w in self.live for j in w.jobs()]
+
+    def flat(self) -> list[Wrap]:
+        return [v for w in self.subs for v in w.flat()]
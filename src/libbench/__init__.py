@@ -1,5 +1,9 @@
 from .Case import Case
 from .Exec import Exec
 from .Item import Item
+from .Load import Load
 from .Pipe import Pipe
-from .Wrap import Wrap, STrace, MTrace, Perf, NVProf, WSS, float_div, fmt_perf_ldc, fmt_perf_tlb, fmt_wss
\ No newline at end of file
+from .Space import Space
+from .Store import Store
+from .Tee import Tee
+from .Wrap import Wrap, STrace, MTrace, Perf, NVProf, WSS, Stack, float_div, fmt_perf_ldc, fmt_perf_tlb, fmt_wss
\ No newline at end of file
@@ -2,113 +2,709 @@
 
 // see: https://stackoverflow.com/questions/6083337/overriding-malloc-using-the-ld-preload-mechanism
 
+#include <math.h>
 #include <stdio.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+#include <fcntl.h>
 #include <dlfcn.h>
-#include <sys/time.h>
+#include <link.h>
+#include <execinfo.h>
+#include <time.h>
+#include <unistd.h>
+#include <pthread.h>
 #include <stdatomic.h>
+#include <sys/mman.h>
+#include <sys/syscall.h>
+
+#if defined(__x86_64__) || defined(__i386__)
+#include <x86intrin.h>
+#endif
+
+
+// file layout, all little-endian u64:
+//   header: u32 magic, u32 version, wall clock in ns, clock ticks, sampling rate, size threshold, clock id
+//   chunk:  (tid << 32 | chunk magic), number of records, base ticks
+//   record: (tick delta << 32 | stack id << 8 | op), pointer, size
+//   calib:  calib magic, 1, 0, then a record of ticks and wall clock in ns at exit
+// each thread fills its own buffer and appends it as one chunk with a single write(2),
+// tick deltas are relative to the previous record of the same thread,
+// a delta that doesn't fit in 32 bits goes into a separate time record
+// the interned stacks are dumped to <trace>.stk at exit, along with <trace>.maps
+#define MT_MAGIC   0x3452544du
+#define MT_CHUNK   0x4b43544du
+#define MT_CALIB   0x4c43544du
+#define MT_VERSION 4u
+#define MT_RECS    8192
+
+// interned call stacks, the record carries slot + 1
+#define MT_DEPTH   16
+#define MT_STACKS  (1ul << 16)
+
+// open-addressing set of the recorded pointers, only used when filtering
+#define MT_TABLE   (1ul << 22)
+#define MT_PROBE   64
+#define MT_TOMB    1ul
+
+enum {
+    MT_MONO,
+    MT_TSC
+};
+
+
+// aggregation mode: counters in a file shared with the sampler, no trace at all
+struct __mt_shm {
+    uint64_t         magic;
+    _Atomic uint64_t live;
+    _Atomic uint64_t peak;
+    _Atomic uint64_t nalloc;
+    _Atomic uint64_t nfree;
+    _Atomic uint64_t bytes;
+    _Atomic uint64_t hist[64];
+};
+
+
+struct __mt_stk {
+    _Atomic uint64_t hash;
+    _Atomic int      ready;
+    int              depth;
+    uint64_t         pc[MT_DEPTH];
+};
+
+enum {
+    MT_FREE,
+    MT_MALLOC,
+    MT_CALLOC,
+    MT_REALLOC,
+    MT_MEMALIGN,
+    MT_TIME = 0xff
+};
+
+
+struct __mt_buf {
+    struct __mt_buf* next;
+    atomic_int       used;
+    uint64_t         tid;
+    uint64_t         last;
+    uint64_t         rng;
+    int64_t          left;
+    size_t           pos;
+    uint64_t         rec[3 * (MT_RECS + 1)];
+};
+
+
+static char*    __user_fn = NULL;
+static int      __user_fd = -1;
+static uint64_t __user_rate  = 0;
+static uint64_t __user_min   = 0;
+static int      __user_clock = MT_MONO;
+
+static _Atomic uint64_t* __user_set = NULL;
+static struct __mt_shm*  __user_shm = NULL;
+static struct __mt_stk*  __user_stk = NULL;
+static int               __user_depth = 0;
+static uintptr_t         __user_lo = 0;
+static uintptr_t         __user_hi = 0;
+static char     __user_buf[4096] __attribute__((aligned(16)));
+
+static pthread_key_t             __user_key;
+static struct __mt_buf* _Atomic  __user_bufs = NULL;
+static __thread struct __mt_buf* __user_tls __attribute__((tls_model("initial-exec"))) = NULL;
+static __thread int              __user_busy __attribute__((tls_model("initial-exec"))) = 0;
+
+static void  (*__user_free          )(void*)                  = NULL;
+static void* (*__user_malloc        )(size_t)                 = NULL;
+static void* (*__user_calloc        )(size_t, size_t)         = NULL;
+static void* (*__user_realloc       )(void*,  size_t)         = NULL;
+static int   (*__user_posix_memalign)(void**, size_t, size_t) = NULL;
+static void* (*__user_aligned_alloc )(size_t, size_t)         = NULL;
+static void* (*__user_memalign      )(size_t, size_t)         = NULL;
+static void* (*__user_valloc        )(size_t)                 = NULL;
+static size_t(*__user_usable_size   )(void*)                  = NULL;
 
 
-static char*   __user_fn = NULL;
-static FILE*   __user_fd = NULL;
-static char    __user_buf[4096];
+static void  __malloc_initialize(void);
+static void  __malloc_finalize  (void);
 
-static void  (*__user_free   )(void*)          = NULL;
-static void* (*__user_malloc )(size_t)         = NULL;
-static void* (*__user_calloc )(size_t, size_t) = NULL;
-static void* (*__user_realloc)(void*,  size_t) = NULL;
 
+static uint64_t __wall(void) {
+    struct timespec cur;
 
-static void  __malloc_initialize(void);
-static void  __malloc_finalize  (void);
+    clock_gettime(CLOCK_REALTIME, &cur);
+
+    return (uint64_t)(cur.tv_sec) * 1000000000ul + (uint64_t)(cur.tv_nsec);
+}
+
+
+static uint64_t __now(void) {
+#if defined(__x86_64__) || defined(__i386__)
+    if (__user_clock == MT_TSC)
+        return __rdtsc();
+#endif
+
+    struct timespec cur;
+
+    clock_gettime(CLOCK_MONOTONIC, &cur);
+
+    return (uint64_t)(cur.tv_sec) * 1000000000ul + (uint64_t)(cur.tv_nsec);
+}
+
+
+static void __flush(struct __mt_buf* b, int fd) {
+    if (b->pos == 0)
+        return;
+
+    b->rec[0] = (b->tid << 32) | MT_CHUNK;
+    b->rec[1] =  b->pos / 3;
+
+    // O_APPEND keeps concurrent chunks intact
+    char*  buf = (char*)(b->rec);
+    size_t len = (b->pos + 3) * sizeof(uint64_t);
+
+    while (len) {
+        ssize_t ret = write(fd, buf, len);
+
+        if (ret <= 0)
+            break;
+
+        buf += ret;
+        len -= ret;
+    }
+
+    b->pos = 0;
+}
+
+
+static struct __mt_buf* __claim(void) {
+    struct __mt_buf* b;
+
+    // reuse a buffer released by an exited thread
+    for (b = atomic_load(&__user_bufs); b; b = b->next) {
+        int v = 0;
+
+        if (atomic_compare_exchange_strong(&b->used, &v, 1))
+            break;
+    }
+
+    if (b == NULL) {
+        b = mmap(NULL, sizeof(*b), PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+
+        if (b == MAP_FAILED)
+            return NULL;
+
+        atomic_store(&b->used, 1);
+
+        b->next = atomic_load(&__user_bufs);
+
+        while (!atomic_compare_exchange_weak(&__user_bufs, &b->next, b))
+            ;
+    }
+
+    b->tid  = (uint64_t)(syscall(SYS_gettid));
+    b->last = __now();
+    b->rng  = b->last ^ (b->tid << 17) ^ (uint64_t)(b);
+    b->left = 0;
+    b->pos  = 0;
+
+    __user_tls = b;
+
+    pthread_setspecific(__user_key, b);
+
+    return b;
+}
+
+
+static void __release(void* p) {
+    struct __mt_buf* b = p;
+
+    if (__user_fd >= 0)
+        __flush(b, __user_fd);
+
+    __user_tls = NULL;
+
+    atomic_store(&b->used, 0);
+}
+
+
+static struct __mt_buf* __buf(void) {
+    struct __mt_buf* b = __user_tls;
+
+    if (__user_fd < 0)
+        return NULL;
+
+    return b ? b : __claim();
+}
+
+
+static void __put(struct __mt_buf* b, uint64_t base, uint64_t hd, uint64_t p, uint64_t sz) {
+    // a chunk starts from the time its first delta is relative to
+    if (b->pos == 0)
+        b->rec[2] = base;
+
+    uint64_t* r = b->rec + 3 + b->pos;
+
+    r[0] = hd;
+    r[1] = p;
+    r[2] = sz;
+
+    if ((b->pos += 3) == 3 * MT_RECS)
+        __flush(b, __user_fd);
+}
+
+
+static void __record(struct __mt_buf* b, int op, void* p, size_t sz, uint64_t stk) {
+    uint64_t ts   = __now();
+    uint64_t base = b->last;
+
+    uint64_t dt = ts > base ? ts - base : 0;
+
+    if (dt >> 32) {
+        __put(b, base, MT_TIME, dt, 0);
+        base += dt;
+        dt    = 0;
+    }
+
+    b->last = base + dt;
+
+    __put(b, base, (dt << 32) | (stk << 8) | (uint64_t)(op), (uint64_t)(p), (uint64_t)(sz));
+}
+
+
+static uint64_t __stack(void) {
+    void* pc[MT_DEPTH + 8];
+
+    if (__user_stk == NULL || __user_busy)
+        return 0;
+
+    // allocations made by the unwinder itself are recorded without a stack
+    __user_busy = 1;
+
+    int n = backtrace(pc, MT_DEPTH + 8);
+    int k = 0;
+
+    __user_busy = 0;
+
+    // skip the frames of this library
+    while (k < n && (uintptr_t)(pc[k]) >= __user_lo && (uintptr_t)(pc[k]) < __user_hi)
+        k++;
+
+    if ((n -= k) > __user_depth)
+        n = __user_depth;
+
+    uint64_t h = 0xcbf29ce484222325ul;
+
+    for (int i = 0; i < n; i++) {
+        h ^= (uint64_t)(pc[k + i]);
+        h *= 0x100000001b3ul;
+    }
+
+    h |= 1;
+
+    for (uint64_t i = 0; i < MT_PROBE; i++) {
+        uint64_t         id = (h + i) & (MT_STACKS - 1);
+        struct __mt_stk* s  = __user_stk + id;
+        uint64_t         v  = 0;
+
+        if (atomic_compare_exchange_strong(&s->hash, &v, h)) {
+            s->depth = n;
+            memcpy(s->pc, pc + k, n * sizeof(uint64_t));
+            atomic_store(&s->ready, 1);
+            return id + 1;
+        }
+
+        if (v != h)
+            continue;
+
+        while (!atomic_load(&s->ready))
+            ;
+
+        if (s->depth == n && memcmp(s->pc, pc + k, n * sizeof(uint64_t)) == 0)
+            return id + 1;
+    }
+
+    return 0;
+}
+
+
+static int __locate(struct dl_phdr_info* info, size_t size, void* data) {
+    uintptr_t self = (uintptr_t)(data);
+
+    (void)(size);
+
+    for (int i = 0; i < info->dlpi_phnum; i++) {
+        const ElfW(Phdr)* ph = info->dlpi_phdr + i;
+
+        uintptr_t lo = info->dlpi_addr + ph->p_vaddr;
+        uintptr_t hi = lo + ph->p_memsz;
+
+        if (ph->p_type == PT_LOAD && self >= lo && self < hi) {
+            __user_lo = lo;
+            __user_hi = hi;
+            return 1;
+        }
+    }
+
+    return 0;
+}
+
+
+static int __open(const char* ext) {
+    char fn[4096];
+
+    if (snprintf(fn, sizeof(fn), "%s.%s", __user_fn, ext) >= (int)(sizeof(fn)))
+        return -1;
+
+    return open(fn, O_WRONLY | O_CREAT | O_TRUNC | O_CLOEXEC, 0644);
+}
+
+
+static void __dump(void) {
+    uint64_t tab[64][MT_DEPTH + 2];
+    size_t   n = 0;
+    int      fd;
+
+    // stack table: slot + 1, depth, frames
+    if ((fd = __open("stk")) < 0)
+        return;
+
+    for (uint64_t i = 0; i <= MT_STACKS; i++) {
+        if (n == 64 || (i == MT_STACKS && n)) {
+            if (write(fd, tab, n * sizeof(tab[0])) != (ssize_t)(n * sizeof(tab[0])))
+                break;
+            n = 0;
+        }
+
+        if (i == MT_STACKS || !atomic_load(&__user_stk[i].ready))
+            continue;
+
+        tab[n][0] = i + 1;
+        tab[n][1] = __user_stk[i].depth;
+
+        memcpy(tab[n++] + 2, __user_stk[i].pc, sizeof(__user_stk[i].pc));
+    }
+
+    close(fd);
+
+    // copy the address space layout for offline symbolization
+    if ((fd = __open("maps")) < 0)
+        return;
+
+    int     fi = open("/proc/self/maps", O_RDONLY | O_CLOEXEC);
+    ssize_t ret;
+    char    buf[4096];
+
+    while (fi >= 0 && (ret = read(fi, buf, sizeof(buf))) > 0)
+        if (write(fd, buf, ret) != ret)
+            break;
+
+    if (fi >= 0)
+        close(fi);
+
+    close(fd);
+}
+
+
+static uint64_t __hash(void* p) {
+    uint64_t h = (uint64_t)(p) >> 4;
+
+    h ^= h >> 33;
+    h *= 0xff51afd7ed558ccdul;
+    h ^= h >> 33;
+
+    return h;
+}
+
+
+static void __track(void* p) {
+    uint64_t h = __hash(p);
+
+    for (int i = 0; i < MT_PROBE; i++) {
+        _Atomic uint64_t* s = __user_set + ((h + i) & (MT_TABLE - 1));
+        uint64_t          v = atomic_load_explicit(s, memory_order_relaxed);
+
+        if (v > MT_TOMB)
+            continue;
+        if (atomic_compare_exchange_strong(s, &v, (uint64_t)(p)))
+            return;
+    }
+
+    // table crowded, the free of p goes unrecorded and is skipped offline
+}
+
+
+static int __untrack(void* p) {
+    uint64_t h = __hash(p);
+
+    for (int i = 0; i < MT_PROBE; i++) {
+        _Atomic uint64_t* s = __user_set + ((h + i) & (MT_TABLE - 1));
+        uint64_t          v = atomic_load_explicit(s, memory_order_relaxed);
+
+        if (v == 0)
+            return 0;
+        if (v == (uint64_t)(p))
+            return atomic_compare_exchange_strong(s, &v, MT_TOMB);
+    }
+
+    return 0;
+}
+
+
+static int __sample(struct __mt_buf* b, size_t sz) {
+    if (sz < __user_min)
+        return 0;
+    if (__user_rate == 0)
+        return 1;
+
+    // poisson byte sampling: the gap to the next sampled byte is exponential with mean rate
+    if ((b->left -= (int64_t)(sz)) > 0)
+        return 0;
+
+    do {
+        b->rng ^= b->rng << 13;
+        b->rng ^= b->rng >> 7;
+        b->rng ^= b->rng << 17;
+
+        double u = ((b->rng >> 11) + 1) * (1.0 / 9007199254740993.0);
+
+        b->left += (int64_t)(-log(u) * (double)(__user_rate)) + 1;
+    } while (b->left <= 0);
+
+    return 1;
+}
+
+
+static void __count(void* p, int inc) {
+    // usable size is known on both ends, unlike the requested size
+    uint64_t sz = __user_usable_size ? __user_usable_size(p) : 0;
+
+    if (inc == 0) {
+        atomic_fetch_sub_explicit(&__user_shm->live,  sz, memory_order_relaxed);
+        atomic_fetch_add_explicit(&__user_shm->nfree, 1,  memory_order_relaxed);
+        return;
+    }
+
+    uint64_t cur = atomic_fetch_add_explicit(&__user_shm->live, sz, memory_order_relaxed) + sz;
+    uint64_t top = atomic_load_explicit     (&__user_shm->peak,     memory_order_relaxed);
+
+    while (cur > top && !atomic_compare_exchange_weak(&__user_shm->peak, &top, cur))
+        ;
+
+    atomic_fetch_add_explicit(&__user_shm->nalloc, 1,  memory_order_relaxed);
+    atomic_fetch_add_explicit(&__user_shm->bytes,  sz, memory_order_relaxed);
+    atomic_fetch_add_explicit(&__user_shm->hist[63 - __builtin_clzl(sz | 1)], 1, memory_order_relaxed);
+}
+
+
+static void __alloc(int op, void* p, size_t sz) {
+    struct __mt_buf* b;
+
+    if (__user_shm) {
+        if (p)
+            __count(p, 1);
+        return;
+    }
+
+    if ((b = __buf()) == NULL || p == NULL || !__sample(b, sz))
+        return;
+
+    if (__user_set)
+        __track(p);
+
+    __record(b, op, p, sz, __stack());
+}
+
+
+// 1 when the free is counted or recorded
+static int __dealloc(int op, void* p) {
+    struct __mt_buf* b;
+
+    if (__user_shm) {
+        __count(p, 0);
+        return 1;
+    }
+
+    if ((b = __buf()) == NULL)
+        return 0;
+    if (__user_set && !__untrack(p))
+        return 0;
+
+    __record(b, op, p, 0, 0);
+
+    return 1;
+}
+
+
+// a failed realloc leaves the old block live, undoes its free
+static void __revive(void* p) {
+    struct __mt_buf* b;
+    uint64_t         sz = __user_usable_size ? __user_usable_size(p) : 0;
+
+    if (__user_shm) {
+        atomic_fetch_add_explicit(&__user_shm->live,  sz, memory_order_relaxed);
+        atomic_fetch_sub_explicit(&__user_shm->nfree, 1,  memory_order_relaxed);
+        return;
+    }
+
+    if ((b = __buf()) == NULL)
+        return;
+
+    if (__user_set)
+        __track(p);
+
+    __record(b, MT_REALLOC, p, sz, __stack());
+}
+
+
+static int __temp_owns(void* p) {
+    return (char*)(p) >= __user_buf && (char*)(p) < __user_buf + sizeof(__user_buf);
+}
 
 
 void free(void* p) {
-    struct timeval cur;
+    if (p == NULL || __temp_owns(p))
+        return;
 
-    gettimeofday(&cur, NULL);
+    // record before the address can be handed out again
+    __dealloc(MT_FREE, p);
 
     if (__user_free)
         __user_free(p);
-
-    if (__user_fd)
-        fprintf(__user_fd, "%ld.%06ld free(%lx)\n",
-                            cur.tv_sec,
-                            cur.tv_usec,
-                           (unsigned long)(p));
 }
 
 
 void* malloc(size_t sz) {
-    struct timeval cur;
-
-    gettimeofday(&cur, NULL);
-
     void* ret = __user_malloc ? __user_malloc(sz) : NULL;
 
-    if (__user_fd)
-        fprintf(__user_fd, "%ld.%06ld malloc(%lx) = %lx\n",
-                            cur.tv_sec,
-                            cur.tv_usec,
-                            sz,
-                           (unsigned long)(ret));
+    __alloc(MT_MALLOC, ret, sz);
 
     return ret;
 }
 
 
 void* calloc(size_t n, size_t sz) {
-    struct timeval cur;
-
-    gettimeofday(&cur, NULL);
-
     void* ret = __user_calloc ? __user_calloc(n, sz) : NULL;
 
-    if (__user_fd)
-        fprintf(__user_fd, "%ld.%06ld calloc(%lx, %lx) = %lx\n",
-                            cur.tv_sec,
-                            cur.tv_usec,
-                            n,
-                            sz,
-                           (unsigned long)(ret));
+    __alloc(MT_CALLOC, ret, n * sz);
 
     return ret;
 }
 
 
 void* realloc(void* p, size_t sz) {
-    struct timeval cur;
+    void* ret;
+
+    if (p && __temp_owns(p)) {
+        // never hand a bootstrap pointer to the real allocator
+        size_t n = __user_buf + sizeof(__user_buf) - (char*)(p);
+
+        if ((ret = malloc(sz)) != NULL)
+            memcpy(ret, p, n < sz ? n : sz);
+
+        return ret;
+    }
+
+    if (p == NULL)
+        return malloc(sz);
+
+    // the old block may be released inside, record it first and take it back when it is not
+    int rec = __dealloc(MT_FREE, p);
+
+    ret = __user_realloc ? __user_realloc(p, sz) : NULL;
+
+    if (ret)
+        __alloc(MT_REALLOC, ret, sz);
+    else if (sz && rec)
+        __revive(p);
+
+    return ret;
+}
+
 
-    gettimeofday(&cur, NULL);
+int posix_memalign(void** p, size_t al, size_t sz) {
+    int ret = __user_posix_memalign ? __user_posix_memalign(p, al, sz) : 12;
 
-    void* ret = __user_realloc ? __user_realloc(p, sz) : NULL;
+    if (ret == 0)
+        __alloc(MT_MEMALIGN, *p, sz);
 
-    if (__user_fd)
-        fprintf(__user_fd, "%ld.%06ld realloc(%lx, %lx) = %lx\n",
-                            cur.tv_sec,
-                            cur.tv_usec,
-                           (unsigned long)(p),
-                            sz,
-                           (unsigned long)(ret));
+    return ret;
+}
+
+
+void* aligned_alloc(size_t al, size_t sz) {
+    void* ret = __user_aligned_alloc ? __user_aligned_alloc(al, sz) : NULL;
+
+    __alloc(MT_MEMALIGN, ret, sz);
+
+    return ret;
+}
+
+
+void* memalign(size_t al, size_t sz) {
+    void* ret = __user_memalign ? __user_memalign(al, sz) : NULL;
+
+    __alloc(MT_MEMALIGN, ret, sz);
+
+    return ret;
+}
+
+
+void* valloc(size_t sz) {
+    void* ret = __user_valloc ? __user_valloc(sz) : NULL;
+
+    __alloc(MT_MEMALIGN, ret, sz);
 
     return ret;
 }
 
 
+size_t malloc_usable_size(void* p) {
+    if (p == NULL || __temp_owns(p))
+        return 0;
+
+    return __user_usable_size ? __user_usable_size(p) : 0;
+}
+
+
 void __temp_free(void* p) {
+    (void)(p);
 }
 
 
 void* __temp_malloc(size_t sz) {
-    static size_t temp_pos = 0;
+    static atomic_size_t temp_pos = 0;
+
+    // keep the bootstrap allocations aligned
+    sz = (sz + 15) & ~(size_t)(15);
 
-    temp_pos += sz;
+    size_t pos = atomic_fetch_add(&temp_pos, sz);
 
-    if (temp_pos > sizeof(__user_buf)) {
+    if (pos + sz > sizeof(__user_buf)) {
         fprintf(stderr, "ERROR: temp_malloc: buffer overflow\n");
         return NULL;
     }
 
-    return __user_buf + (temp_pos - sz);
+    return __user_buf + pos;
+}
+
+
+void* __temp_calloc(size_t n, size_t sz) {
+    // static storage is zeroed already
+    return __temp_malloc(n * sz);
+}
+
+
+static void __malloc_atfork(void) {
+    // the child must not replay the records buffered by its parent
+    for (struct __mt_buf* b = atomic_load(&__user_bufs); b; b = b->next) {
+        b->pos = 0;
+
+        if (b != __user_tls)
+            atomic_store(&b->used, 0);
+    }
+
+    if (__user_tls)
+        __user_tls->tid = (uint64_t)(syscall(SYS_gettid));
 }
 
 
@@ -116,6 +712,7 @@ void __attribute__((constructor)) __malloc_initialize(void) {
     // for dlsym
     __user_free    = __temp_free;
     __user_malloc  = __temp_malloc;
+    __user_calloc  = __temp_calloc;
 
     char* (*_getenv )(const char*);
 
@@ -137,17 +734,102 @@ void __attribute__((constructor)) __malloc_initialize(void) {
     if ((_realloc = dlsym(RTLD_NEXT, "realloc")) == NULL)
         goto dl_err;
 
+    // optional
+    __user_posix_memalign = dlsym(RTLD_NEXT, "posix_memalign"    );
+    __user_aligned_alloc  = dlsym(RTLD_NEXT, "aligned_alloc"     );
+    __user_memalign       = dlsym(RTLD_NEXT, "memalign"          );
+    __user_valloc         = dlsym(RTLD_NEXT, "valloc"            );
+    __user_usable_size    = dlsym(RTLD_NEXT, "malloc_usable_size");
+
     __user_free    = _free;
     __user_malloc  = _malloc;
     __user_calloc  = _calloc;
     __user_realloc = _realloc;
 
+    if (pthread_key_create(&__user_key, __release))
+        return;
+
+    pthread_atfork(NULL, NULL, __malloc_atfork);
+
+    char* env;
+
     if ((__user_fn = _getenv("MALLOC_TRACE")) == NULL)
         __user_fn = "mtrace.log";
-    if ((__user_fd = fopen(__user_fn, "wce")) == NULL)
+    if ((env = _getenv("MALLOC_TRACE_RATE")) != NULL)
+        __user_rate = strtoull(env, NULL, 0);
+    if ((env = _getenv("MALLOC_TRACE_MIN" )) != NULL)
+        __user_min  = strtoull(env, NULL, 0);
+#if defined(__x86_64__) || defined(__i386__)
+    if ((env = _getenv("MALLOC_TRACE_CLOCK")) != NULL && strcmp(env, "tsc") == 0)
+        __user_clock = MT_TSC;
+#endif
+
+    if ((env = _getenv("MALLOC_TRACE_SHM")) != NULL) {
+        __user_fn = env;
+
+        int fd = open(__user_fn, O_RDWR | O_CREAT | O_CLOEXEC, 0644);
+
+        if (fd < 0 || ftruncate(fd, sizeof(struct __mt_shm)) < 0)
+            goto io_err;
+
+        void* shm = mmap(NULL, sizeof(struct __mt_shm), PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+
+        close(fd);
+
+        if (shm == MAP_FAILED)
+            goto io_err;
+
+        __user_shm        = shm;
+        __user_shm->magic = MT_MAGIC;
+
+        return;
+    }
+
+    if ((env = _getenv("MALLOC_TRACE_STACK")) != NULL && (__user_depth = atoi(env)) > 0) {
+        void* stk = mmap(NULL, MT_STACKS * sizeof(struct __mt_stk), PROT_READ | PROT_WRITE,
+                                                                   MAP_PRIVATE | MAP_ANONYMOUS | MAP_NORESERVE, -1, 0);
+        void* tmp[1];
+
+        if (__user_depth > MT_DEPTH)
+            __user_depth = MT_DEPTH;
+
+        dl_iterate_phdr(__locate, (void*)(__malloc_initialize));
+
+        // the first backtrace loads the unwinder, which allocates
+        __user_busy = 1;
+        backtrace(tmp, 1);
+        __user_busy = 0;
+
+        if (stk != MAP_FAILED)
+            __user_stk = stk;
+    }
+
+    // frees are only recorded for the recorded allocations
+    if (__user_rate || __user_min) {
+        void* set = mmap(NULL, MT_TABLE * sizeof(uint64_t), PROT_READ | PROT_WRITE,
+                                                          MAP_PRIVATE | MAP_ANONYMOUS | MAP_NORESERVE, -1, 0);
+        if (set != MAP_FAILED)
+            __user_set = set;
+    }
+
+    int fd = open(__user_fn, O_WRONLY | O_CREAT | O_TRUNC | O_APPEND | O_CLOEXEC, 0644);
+
+    if (fd < 0)
+        goto io_err;
+
+    uint64_t hdr[6] = {(uint64_t)(MT_VERSION) << 32 | MT_MAGIC,
+                        __wall(),
+                        __now(),
+                        __user_rate,
+                        __user_min,
+                        (uint64_t)(__user_clock)};
+
+    if (write(fd, hdr, sizeof(hdr)) != sizeof(hdr)) {
+        close(fd);
         goto io_err;
+    }
 
-    setvbuf(__user_fd, __user_buf, _IOFBF, sizeof(__user_buf));
+    __user_fd = fd;
 
     return;
 
@@ -156,16 +838,32 @@ dl_err:
     return;
 
 io_err:
-    fprintf(stderr, "ERROR: fopen: %s", __user_fn);
+    fprintf(stderr, "ERROR: open: %s", __user_fn);
     perror ("");
     return;
 }
 
 
 void __attribute__((destructor)) __malloc_finalize(void) {
-    if (__user_fd == NULL)
+    int fd = __user_fd;
+
+    if (fd < 0)
         return;
 
-    fclose(__user_fd);
-    __user_fd = NULL;
-}
\ No newline at end of file
+    // stop recording, then drain every thread's buffer
+    __user_fd = -1;
+
+    for (struct __mt_buf* b = atomic_load(&__user_bufs); b; b = b->next)
+        __flush(b, fd);
+
+    // lets the decoder convert ticks into ns
+    uint64_t cal[6] = {MT_CALIB, 1, 0, __now(), __wall(), 0};
+
+    if (write(fd, cal, sizeof(cal)) != sizeof(cal))
+        perror("ERROR: write");
+
+    close(fd);
+
+    if (__user_stk)
+        __dump();
+}
@@ -0,0 +1,422 @@
+#define _GNU_SOURCE
+
+// in-process replacement of strace -e trace=%memory, writes the records of STrace.post directly:
+//   + utc size   brk grows
+//   - utc size   brk shrinks
+//   * utc addr size prot kind   kind is a(nonymous) or f(ile), mremap leaves both as -
+//   / utc addr size
+//   = utc addr size prot
+// only calls through the dynamic symbols are seen, glibc's malloc calls __mmap/__munmap/__sbrk internally:
+//   the program break is polled on every hooked call and at exit
+//   the allocations glibc serves with a mapping of their own are read from the chunk header around malloc and free,
+//   only when the next allocator is glibc's, e.g. not behind libmtrace.so or another allocator
+//   the heaps of the non-main arenas, mapped and grown with mprotect inside malloc, are still not seen
+
+#include <stdio.h>
+#include <stdint.h>
+#include <stdarg.h>
+#include <stdlib.h>
+#include <string.h>
+#include <fcntl.h>
+#include <dlfcn.h>
+#include <time.h>
+#include <unistd.h>
+#include <pthread.h>
+#include <stdatomic.h>
+#include <sys/mman.h>
+#include <sys/syscall.h>
+#include <gnu/lib-names.h>
+
+
+static char*     __user_fn  = NULL;
+static int       __user_fd  = -1;
+static char      __user_buf[1 << 16];
+static size_t    __user_pos = 0;
+static uintptr_t __user_cur = 0;
+
+static atomic_flag __user_lock = ATOMIC_FLAG_INIT;
+
+static void* (*__user_mmap    )(void*, size_t, int, int, int, off_t) = NULL;
+static int   (*__user_munmap  )(void*, size_t)                       = NULL;
+static void* (*__user_mremap  )(void*, size_t, size_t, int, ...)     = NULL;
+static int   (*__user_mprotect)(void*, size_t, int)                  = NULL;
+static int   (*__user_brk     )(void*)                               = NULL;
+static void* (*__user_sbrk    )(intptr_t)                            = NULL;
+
+static void  (*__user_free          )(void*)                  = NULL;
+static void* (*__user_malloc        )(size_t)                 = NULL;
+static void* (*__user_calloc        )(size_t, size_t)         = NULL;
+static void* (*__user_realloc       )(void*,  size_t)         = NULL;
+static int   (*__user_posix_memalign)(void**, size_t, size_t) = NULL;
+static void* (*__user_aligned_alloc )(size_t, size_t)         = NULL;
+static void* (*__user_memalign      )(size_t, size_t)         = NULL;
+
+static int __user_glibc = 0;
+
+// for dlsym, before the allocator is resolved
+static char      __user_tmp[4096] __attribute__((aligned(16)));
+static atomic_size_t __user_top = 0;
+
+
+static void  __strace_initialize(void);
+static void  __strace_finalize  (void);
+
+
+static void __flush(void) {
+    char*  buf = __user_buf;
+    size_t len = __user_pos;
+
+    while (len) {
+        ssize_t ret = write(__user_fd, buf, len);
+
+        if (ret <= 0)
+            break;
+
+        buf += ret;
+        len -= ret;
+    }
+
+    __user_pos = 0;
+}
+
+
+static void __lock(void) {
+    while (atomic_flag_test_and_set_explicit(&__user_lock, memory_order_acquire))
+        ;
+}
+
+
+static void __unlock(void) {
+    atomic_flag_clear_explicit(&__user_lock, memory_order_release);
+}
+
+
+// caller holds the lock
+static void __emit(const struct timespec* ts, char op, uintptr_t addr, size_t sz, const char* ext) {
+    if (__user_fd < 0)
+        return;
+
+    if (sizeof(__user_buf) - __user_pos < 128)
+        __flush();
+
+    int n = op == '+' || op == '-' ?
+        snprintf(__user_buf + __user_pos, 128, "%c %ld.%06ld %lx\n",         op, ts->tv_sec, ts->tv_nsec / 1000,       sz) :
+        snprintf(__user_buf + __user_pos, 128, "%c %ld.%06ld 0x%lx %lx%s\n", op, ts->tv_sec, ts->tv_nsec / 1000, addr, sz, ext);
+
+    if (n > 0)
+        __user_pos += n;
+}
+
+
+// caller holds the lock
+static void __poll_brk(const struct timespec* ts) {
+    uintptr_t cur = (uintptr_t)(syscall(SYS_brk, 0));
+
+    if (__user_cur && cur != __user_cur)
+        __emit(ts, cur > __user_cur ? '+' : '-', 0, cur > __user_cur ? cur - __user_cur : __user_cur - cur, "");
+
+    __user_cur = cur;
+}
+
+
+static void __record(char op, uintptr_t addr, size_t sz, const char* ext) {
+    struct timespec ts;
+
+    clock_gettime(CLOCK_REALTIME, &ts);
+
+    __lock();
+
+    __poll_brk(&ts);
+
+    if (op)
+        __emit(&ts, op, addr, sz, ext);
+
+    __unlock();
+}
+
+
+static const char* __attr(char* buf, int prot, int flags) {
+    buf[0] = ' ';
+    buf[1] = prot & PROT_READ  ? 'r' : '-';
+    buf[2] = prot & PROT_WRITE ? 'w' : '-';
+    buf[3] = prot & PROT_EXEC  ? 'x' : '-';
+    buf[4] = ' ';
+    buf[5] = flags & MAP_ANONYMOUS ? 'a' : 'f';
+    buf[6] = 0;
+
+    // mprotect has no kind
+    if (flags < 0)
+        buf[4] = 0;
+
+    return buf;
+}
+
+
+#define RESOLVE(f) (__user_##f ? __user_##f : (__user_##f = dlsym(RTLD_NEXT, #f)))
+
+
+void* mmap(void* p, size_t sz, int prot, int flags, int fd, off_t off) {
+    void* ret = RESOLVE(mmap) ? __user_mmap(p, sz, prot, flags, fd, off) : MAP_FAILED;
+
+    char  buf[8];
+
+    if (ret != MAP_FAILED)
+        __record('*', (uintptr_t)(ret), sz, __attr(buf, prot, flags));
+
+    return ret;
+}
+
+
+void* mmap64(void* p, size_t sz, int prot, int flags, int fd, off_t off) {
+    return mmap(p, sz, prot, flags, fd, off);
+}
+
+
+int munmap(void* p, size_t sz) {
+    int ret = RESOLVE(munmap) ? __user_munmap(p, sz) : -1;
+
+    if (ret == 0)
+        __record('/', (uintptr_t)(p), sz, "");
+
+    return ret;
+}
+
+
+void* mremap(void* p, size_t old_sz, size_t new_sz, int flags, ...) {
+    void*   new = NULL;
+    va_list ap;
+
+    if (flags & MREMAP_FIXED) {
+        va_start(ap, flags);
+        new = va_arg(ap, void*);
+        va_end  (ap);
+    }
+
+    void* ret = RESOLVE(mremap) ? __user_mremap(p, old_sz, new_sz, flags, new) : MAP_FAILED;
+
+    if (ret != MAP_FAILED) {
+        __record('/', (uintptr_t)(p),   old_sz, "");
+        __record('*', (uintptr_t)(ret), new_sz, " - -");
+    }
+
+    return ret;
+}
+
+
+int mprotect(void* p, size_t sz, int prot) {
+    int ret = RESOLVE(mprotect) ? __user_mprotect(p, sz, prot) : -1;
+
+    char buf[8];
+
+    if (ret == 0)
+        __record('=', (uintptr_t)(p), sz, __attr(buf, prot, -1));
+
+    return ret;
+}
+
+
+int brk(void* p) {
+    int ret = RESOLVE(brk) ? __user_brk(p) : -1;
+
+    __record(0, 0, 0, "");
+
+    return ret;
+}
+
+
+void* sbrk(intptr_t inc) {
+    void* ret = RESOLVE(sbrk) ? __user_sbrk(inc) : (void*)(-1);
+
+    __record(0, 0, 0, "");
+
+    return ret;
+}
+
+
+// glibc's chunk header: prev_size, size | flags, a chunk with IS_MMAPPED is a mapping of its own,
+// starting prev_size bytes before the header
+#define ST_MMAPPED 0x2ul
+
+
+static int __temp_owns(void* p) {
+    return (char*)(p) >= __user_tmp && (char*)(p) < __user_tmp + sizeof(__user_tmp);
+}
+
+
+static int __chunk(void* p, uintptr_t* addr, size_t* sz) {
+    // any other allocator has no such header to read
+    if (!__user_glibc || p == NULL || __temp_owns(p))
+        return 0;
+
+    size_t*   h   = (size_t*)(p) - 2;
+    uintptr_t pg  = (uintptr_t)(sysconf(_SC_PAGESIZE)) - 1;
+
+    if (!(h[1] & ST_MMAPPED))
+        return 0;
+
+    *addr = (uintptr_t)(h) - h[0];
+    *sz   = (h[1] & ~7ul) + h[0];
+
+    // a mapping starts and ends on a page
+    return ((*addr | *sz) & pg) == 0;
+}
+
+
+static void* __mapped(void* p) {
+    uintptr_t addr;
+    size_t    sz;
+
+    if (__chunk(p, &addr, &sz))
+        __record('*', addr, sz, " rw- a");
+
+    return p;
+}
+
+
+static void* __temp_malloc(size_t sz) {
+    size_t pos = atomic_fetch_add(&__user_top, (sz + 15) & ~15ul);
+
+    return pos + sz <= sizeof(__user_tmp) ? __user_tmp + pos : NULL;
+}
+
+
+void free(void* p) {
+    uintptr_t addr;
+    size_t    sz;
+    int       map = __chunk(p, &addr, &sz);
+
+    if (p == NULL || __temp_owns(p))
+        return;
+
+    if (__user_free)
+        __user_free(p);
+
+    if (map)
+        __record('/', addr, sz, "");
+}
+
+
+void* malloc(size_t sz) {
+    return __mapped(__user_malloc ? __user_malloc(sz) : __temp_malloc(sz));
+}
+
+
+void* calloc(size_t n, size_t sz) {
+    // static storage is zeroed already
+    return __mapped(__user_calloc ? __user_calloc(n, sz) : __temp_malloc(n * sz));
+}
+
+
+void* realloc(void* p, size_t sz) {
+    uintptr_t old_addr = 0, new_addr = 0;
+    size_t    old_sz   = 0, new_sz   = 0;
+
+    if (p && __temp_owns(p)) {
+        size_t n   = __user_tmp + sizeof(__user_tmp) - (char*)(p);
+        void*  ret = malloc(sz);
+
+        if (ret)
+            memcpy(ret, p, sz < n ? sz : n);
+
+        return ret;
+    }
+
+    int   old = __chunk(p, &old_addr, &old_sz);
+    void* ret = __user_realloc ? __user_realloc(p, sz) : NULL;
+    int   new = __chunk(ret, &new_addr, &new_sz);
+
+    // as strace shows the mremap, nothing when the mapping is left as it was
+    if ((ret || sz == 0) && old && !(new && new_addr == old_addr && new_sz == old_sz))
+        __record('/', old_addr, old_sz, "");
+    if (new && !(old && new_addr == old_addr && new_sz == old_sz))
+        __record('*', new_addr, new_sz, old ? " - -" : " rw- a");
+
+    return ret;
+}
+
+
+int posix_memalign(void** p, size_t al, size_t sz) {
+    int ret = __user_posix_memalign ? __user_posix_memalign(p, al, sz) : 12;
+
+    if (ret == 0)
+        __mapped(*p);
+
+    return ret;
+}
+
+
+void* aligned_alloc(size_t al, size_t sz) {
+    return __mapped(__user_aligned_alloc ? __user_aligned_alloc(al, sz) : NULL);
+}
+
+
+void* memalign(size_t al, size_t sz) {
+    return __mapped(__user_memalign ? __user_memalign(al, sz) : NULL);
+}
+
+
+static int __libc(void* f) {
+    // dladdr, unlike dlopen, does not allocate
+    Dl_info     di;
+    const char* s;
+
+    if (f == NULL || !dladdr(f, &di) || di.dli_fname == NULL)
+        return 0;
+
+    s = strrchr(di.dli_fname, '/');
+
+    return strcmp(s ? s + 1 : di.dli_fname, LIBC_SO) == 0;
+}
+
+
+static void __strace_atfork(void) {
+    // the child must not replay the records buffered by its parent
+    __user_pos = 0;
+
+    atomic_flag_clear(&__user_lock);
+}
+
+
+void __attribute__((constructor)) __strace_initialize(void) {
+    if ((__user_fn = getenv("STRACE_TRACE")) == NULL)
+        __user_fn = "strace.log.post";
+
+    // whatever dlsym allocates comes from the bootstrap buffer until then
+    __user_calloc         = dlsym(RTLD_NEXT, "calloc"        );
+    __user_malloc         = dlsym(RTLD_NEXT, "malloc"        );
+    __user_realloc        = dlsym(RTLD_NEXT, "realloc"       );
+    __user_posix_memalign = dlsym(RTLD_NEXT, "posix_memalign");
+    __user_aligned_alloc  = dlsym(RTLD_NEXT, "aligned_alloc" );
+    __user_memalign       = dlsym(RTLD_NEXT, "memalign"      );
+    __user_free           = dlsym(RTLD_NEXT, "free"          );
+
+    __user_glibc = __libc(__user_calloc) && __libc(__user_malloc) && __libc(__user_realloc) && __libc(__user_posix_memalign) &&
+                   __libc(__user_aligned_alloc) && __libc(__user_memalign) && __libc(__user_free);
+
+    pthread_atfork(__lock, __unlock, __strace_atfork);
+
+    if ((__user_fd = open(__user_fn, O_WRONLY | O_CREAT | O_TRUNC | O_APPEND | O_CLOEXEC, 0644)) < 0) {
+        fprintf(stderr, "ERROR: open: %s", __user_fn);
+        perror ("");
+        return;
+    }
+
+    __record(0, 0, 0, "");
+}
+
+
+void __attribute__((destructor)) __strace_finalize(void) {
+    if (__user_fd < 0)
+        return;
+
+    __record(0, 0, 0, "");
+
+    __lock();
+
+    __flush();
+
+    close(__user_fd);
+    __user_fd = -1;
+
+    __unlock();
+}
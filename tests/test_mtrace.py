@@ -0,0 +1,106 @@
+import os
+import shutil
+import struct
+import subprocess
+
+import pytest
+
+
+SRC = os.path.join(os.path.dirname(__file__), '..', 'src', 'libbench', 'c', 'libmtrace.c')
+
+# 8192 records fill a chunk, the allocation after the gap starts the next one
+PROG = r'''
+#include <stdlib.h>
+#include <unistd.h>
+
+int main(void) {
+    static void* p[8192];
+
+    for (int i = 0; i < 8192; i++)
+        p[i] = malloc(16);
+
+    usleep(1500000);
+
+    return malloc(16) == NULL;
+}
+'''
+
+
+# a realloc that fails leaves the block live
+FAIL = r'''
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+
+int main(void) {
+    void* p = malloc(100);
+
+    printf("%lx\n", (unsigned long)(p));
+
+    return realloc(p, SIZE_MAX / 2) != NULL;
+}
+'''
+
+
+def chunks(fn: str):
+    # (base, [(delta, op, ptr, size)]) of every chunk, see the layout in libmtrace.c
+    with open(fn, 'rb') as fi:
+        buf = fi.read()
+
+    pos = struct.calcsize('<IIQQQQQ')
+
+    while pos + 24 <= len(buf):
+        hd, n, base = struct.unpack_from('<QQQ', buf, pos)
+        pos += 24
+
+        if hd & 0xffffffff == 0x4b43544d:
+            yield base, [(h >> 32, h & 0xff, p, sz) for h, p, sz in struct.iter_unpack('<QQQ', buf[pos:pos + n * 24])]
+
+        pos += n * 24
+
+
+def run(tmp_path, prog: str) -> tuple[str, str]:
+    # (trace, stdout) of prog under the preload
+    so  = tmp_path / 'libmtrace.so'
+    exe = tmp_path / 'prog'
+
+    (tmp_path / 'prog.c').write_text(prog)
+
+    subprocess.run(['cc', '-O2', '-shared', '-fPIC', '-o', so, SRC, '-ldl', '-lpthread', '-lm'], check=True)
+    subprocess.run(['cc', '-O0', '-o', exe, tmp_path / 'prog.c'], check=True)
+
+    fn  = tmp_path / 'trace'
+    env = os.environ | {'LD_PRELOAD': str(so), 'MALLOC_TRACE': str(fn), 'MALLOC_TRACE_STACK': '0'}
+
+    return fn, subprocess.run([exe], env=env, check=True, capture_output=True, text=True).stdout
+
+
+@pytest.mark.skipif(shutil.which('cc') is None, reason='no c compiler')
+def test_gap_across_chunks(tmp_path):
+    fn, _ = run(tmp_path, PROG)
+
+    ts = []
+
+    for base, recs in chunks(fn):
+        for dt, op, p, _ in recs:
+            base += dt
+            if op == 0xff:
+                base += p
+            else:
+                ts.append(base)
+
+    gap = max(b - a for a, b in zip(ts, ts[1:]))
+
+    assert ts == sorted(ts)
+    assert 1.4e9 < gap < 2.4e9
+
+
+@pytest.mark.skipif(shutil.which('cc') is None, reason='no c compiler')
+def test_failed_realloc(tmp_path):
+    fn, out = run(tmp_path, FAIL)
+    ptr     = int(out, 16)
+
+    ops = [op for _, recs in chunks(fn) for _, op, p, _ in recs if p == ptr and op != 0xff]
+
+    # malloc, the free before the call, the block back after it
+    assert ops == [1, 0, 3]
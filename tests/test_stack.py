@@ -0,0 +1,53 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+try:
+    import libbench
+except ImportError as e:
+    pytest.skip(f'libbench: {e}', allow_module_level=True)
+
+
+# stands in for perf stat: the command, then one interval of counts to --log-fd
+PERF = r'''#!/bin/sh
+while [ "$1" != "--" ]; do
+    [ "$1" = "--log-fd" ] && fd=$2
+    shift
+done
+shift
+"$@"
+rc=$?
+eval "echo 1.000,5,,cycles >&$fd"
+exit $rc
+'''
+
+DRV = r'''
+import os, sys, types
+from libbench import Stack, WSS, Perf
+
+i = types.SimpleNamespace(rt_args=['sleep', '0.5'], rt_env={}, case='t', rt_post=-1)
+p = Perf('cycles', mode='stat')
+w = WSS(dly=0.1)
+
+if not Stack(*([p, w] if sys.argv[2] == 'first' else [w, p]))(i, sys.argv[1], 'm', 0):
+    os.execvpe(i.rt_args[0], i.rt_args, os.environ | i.rt_env)
+'''
+
+
+@pytest.mark.parametrize('pos', ['first', 'last'])
+def test_stack_perf_stat(tmp_path, pos):
+    # the stat watcher sees EOF on its log pipe next to another watcher
+    fn = tmp_path / 'perf'
+    fn.write_text(PERF)
+    fn.chmod(0o755)
+
+    env = dict(os.environ,
+               PATH=f'{tmp_path}:{os.environ.get("PATH", "")}',
+               PYTHONPATH=os.path.dirname(os.path.dirname(libbench.__file__)))
+
+    subprocess.run([sys.executable, '-c', DRV, str(tmp_path), pos], env=env, check=True, timeout=30)
+
+    with open(tmp_path / 't-m-0-perf.data.post') as fi:
+        assert fi.read().split() == ['5']